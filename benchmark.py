@@ -0,0 +1,327 @@
+from ngsildclient import ContextBrokerClient, RetryPolicy
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from datetime import datetime, timedelta, timezone
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# offline benchmark: a local stand-in for Scorpio/QuantumLeap and the Keycloak token endpoint,
+# with configurable latency, page cap and error injection
+
+class MockBroker:
+
+    def __init__(self, entity_count=5000, temporal_instances=2000, latency=0.002, page_cap=1000, error_rate=0.0, token_lifetime=3600, url=None) -> None:
+        self.entity_count = entity_count
+        self.temporal_instances = temporal_instances
+        self.latency = latency
+        self.page_cap = page_cap
+        self.error_rate = error_rate
+        self.token_lifetime = token_lifetime
+        self.token_requests = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.start_time = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        self.server = None
+        self.thread = None
+        self.url = url
+        # with an url the broker only describes one served by another process
+        if url is None:
+            self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+            self.server.daemon_threads = True
+            self.server.request_queue_size = 1024
+            self.url = 'http://127.0.0.1:'+str(self.server.server_port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mock-broker', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def entity_id(self, i) -> str:
+        return 'urn:ngsi-ld:Device:bench-'+str(i)
+
+    def entity(self, i) -> dict:
+        return {
+            'id': self.entity_id(i),
+            'type': 'Device',
+            'temperature': {'type': 'Property', 'value': 20+i%10, 'observedAt': '2025-01-01T00:00:00.000Z'},
+            'batteryLevel': {'type': 'Property', 'value': 0.5},
+        }
+
+    def observed_at(self, n) -> str:
+        return (self.start_time+timedelta(seconds=n)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def temporal_entity(self, i, last_n) -> dict:
+        first = max(self.temporal_instances-last_n, 0)
+        return {
+            'id': self.entity_id(i),
+            'type': 'Device',
+            'temperature': [{'type': 'Property', 'value': n%30, 'observedAt': self.observed_at(n)} for n in range(first, self.temporal_instances)],
+        }
+
+    def ql_page(self, last_n, offset) -> dict:
+        end = min(offset+last_n, self.temporal_instances)
+        return {
+            'index': [self.observed_at(n) for n in range(offset, end)],
+            'attributes': [{'attrName': 'temperature', 'values': [n%30 for n in range(offset, end)]}],
+        }
+
+    def _handler_class(self):
+        broker = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=None, headers=None):
+                data = json.dumps(body).encode('utf-8') if body is not None else b''
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def _inject(self) -> bool:
+                with broker.lock:
+                    broker.requests += 1
+                if broker.latency:
+                    time.sleep(broker.latency)
+                if broker.error_rate and random.random() < broker.error_rate:
+                    self._reply(503, {'type': 'https://uri.etsi.org/ngsi-ld/errors/InternalError', 'title': 'injected error'}, {'Retry-After': '0'})
+                    return True
+                return False
+
+            def do_POST(self):
+                request = urlsplit(self.path)
+                self._read_body()
+                if request.path.endswith('/protocol/openid-connect/token'):
+                    with broker.lock:
+                        broker.token_requests += 1
+                    self._reply(200, {'access_token': 'bench-'+str(broker.token_requests), 'expires_in': broker.token_lifetime, 'refresh_token': 'bench-refresh', 'refresh_expires_in': broker.token_lifetime*10})
+                    return
+                if self._inject():
+                    return
+                self._reply(204)
+
+            def do_GET(self):
+                if self._inject():
+                    return
+                request = urlsplit(self.path)
+                query = {k: v[0] for k, v in parse_qs(request.query).items()}
+                path = request.path.split('/ngsi-ld/v1/', 1)[-1].strip('/')
+                segments = path.split('/')
+                if path == 'types':
+                    self._reply(200, {'typeList': ['Device']})
+                elif path == 'entities':
+                    offset = int(query.get('offset', 0))
+                    limit = min(int(query.get('limit', 20)), broker.page_cap)
+                    body = [broker.entity(i) for i in range(offset, min(offset+limit, broker.entity_count))]
+                    headers = {'NGSILD-Results-Count': str(broker.entity_count)} if query.get('count') == 'true' else None
+                    self._reply(200, body, headers)
+                elif segments[0] == 'entities' and len(segments) == 2:
+                    i = int(segments[1].rsplit('-', 1)[1])
+                    if 'last_n' in query:
+                        offset = int(query.get('offset', 0))
+                        if offset >= broker.temporal_instances:
+                            self._reply(404, {'error': 'NotFound'})
+                        else:
+                            self._reply(200, broker.ql_page(int(query['last_n']), offset))
+                    else:
+                        self._reply(200, broker.entity(i))
+                elif path == 'temporal/entities':
+                    offset = int(query.get('offset', 0))
+                    limit = min(int(query.get('limit', 20)), broker.page_cap)
+                    last_n = int(query.get('lastN', 1000))
+                    body = [broker.temporal_entity(i, last_n) for i in range(offset, min(offset+limit, broker.entity_count))]
+                    headers = {'NGSILD-Results-Count': str(broker.entity_count)} if query.get('count') == 'true' else None
+                    self._reply(200, body, headers)
+                elif segments[:2] == ['temporal', 'entities'] and len(segments) == 3:
+                    self._reply(200, broker.temporal_entity(int(segments[2].rsplit('-', 1)[1]), int(query.get('lastN', 1000))))
+                else:
+                    self._reply(404, {'error': 'NotFound', 'detail': path})
+
+        return Handler
+
+
+def bulk_reads(client, broker, args):
+    def read(i):
+        return client.get_entity(broker.entity_id(i%broker.entity_count))
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for _ in pool.map(read, range(args.reads)):
+            pass
+
+def paginated_scan(client, broker, args):
+    count = sum(1 for _ in client.iter_entities('Device', page_size=args.page_size))
+    if count != broker.entity_count:
+        raise RuntimeError('paginated scan returned '+str(count)+' of '+str(broker.entity_count)+' entities')
+
+def temporal_export(client, broker, args):
+    ql = ContextBrokerClient(base_url=broker.url, tenant=client.tenant, retry_policy=client.retry_policy, instrumentation=client.instrumentation)
+    entities = [broker.entity_id(i) for i in range(args.export_entities)]
+    with tempfile.TemporaryDirectory() as export_dir:
+        client.ql_download_temporal_entities(ql, entities=entities, batch_size=args.export_batch_size, scorpio_workers=args.workers, ql_workers=args.workers, checkpoint_file=None, export_dir=export_dir)
+
+def batch_writes(client, broker, args):
+    entities = (broker.entity(i) for i in range(args.writes))
+    result = client.batch_upsert(entities, chunk_size=args.chunk_size, workers=args.workers, retry=3, verbose=False)
+    if result['errors']:
+        raise RuntimeError(str(len(result['errors']))+' batch upserts failed')
+
+def token_expiry(client, broker, args):
+    deadline = time.monotonic()+args.token_duration
+    def read_until_deadline(worker):
+        i = worker
+        while time.monotonic() < deadline:
+            client.get_entity(broker.entity_id(i%broker.entity_count))
+            i += args.workers
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(read_until_deadline, range(args.workers)))
+
+SCENARIOS = {
+    'bulk_reads': bulk_reads,
+    'paginated_scan': paginated_scan,
+    'temporal_export': temporal_export,
+    'batch_writes': batch_writes,
+    'token_expiry': token_expiry,
+}
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(q*len(sorted_values)), len(sorted_values)-1)]
+
+def run_scenario(name, broker, args) -> dict:
+    client_args = {}
+    if name == 'token_expiry':
+        client_args = {'keycloak_url': broker.url+'/', 'keycloak_realm': 'bench', 'client_id': 'bench', 'client_secret_key': 'bench'}
+    client = ContextBrokerClient(base_url=broker.url, tenant='bench', retry_policy=RetryPolicy(max_attempts=3, base_delay=0.01), **client_args)
+    client.set_pool_size(args.workers)
+    latencies = []
+    client.instrumentation.add_response_hook(lambda method, url, tenant, status_code, elapsed: latencies.append(elapsed))
+    broker.token_requests = 0
+
+    if args.memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    SCENARIOS[name](client, broker, args)
+    wall_time = time.perf_counter()-started
+    peak_memory = 0
+    if args.memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    if client.token_manager:
+        client.token_manager.stop()
+
+    latencies.sort()
+    counters = client.metrics()['counters']
+    return {
+        'requests': counters['requests'],
+        'retries': counters['retries'],
+        'errors': counters['errors'],
+        'token_requests': broker.token_requests,
+        'wall_time_s': round(wall_time, 3),
+        'requests_per_s': round(counters['requests']/wall_time, 1) if wall_time else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5)*1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99)*1000, 3),
+        'peak_memory_kb': round(peak_memory/1024, 1),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def run_scenario_process(name, url, args) -> dict:
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('ngsildclient').setLevel(logging.ERROR)
+    broker = MockBroker(args.entities, args.temporal_instances, args.latency, args.page_cap, args.error_rate, args.token_lifetime, url=url)
+    return run_scenario(name, broker, args)
+
+def run_isolated(name, broker, args) -> dict:
+    # a fresh interpreter per scenario so max_rss_kb is this scenario's own high-water mark,
+    # the mock broker keeps serving from this process and counts the token requests
+    broker.token_requests = 0
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        result = pool.submit(run_scenario_process, name, broker.url, args).result()
+    result['token_requests'] = broker.token_requests
+    return result
+
+def print_results(results, baseline=None):
+    columns = ('requests', 'requests_per_s', 'p50_ms', 'p99_ms', 'peak_memory_kb', 'max_rss_kb', 'retries', 'token_requests', 'wall_time_s')
+    print('%-16s' % 'scenario'+''.join('%16s' % c for c in columns))
+    for name, result in results.items():
+        print('%-16s' % name+''.join('%16s' % result[c] for c in columns))
+        if baseline and name in baseline:
+            deltas = []
+            for c in columns:
+                before = baseline[name].get(c)
+                deltas.append('%+15.1f%%' % ((result[c]-before)*100.0/before) if before else '%16s' % '-')
+            print('%-16s' % '  vs baseline'+''.join(deltas))
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline ContextBrokerClient benchmark against a local mock NGSI-LD broker')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run: '+', '.join(SCENARIOS)+' (default: all)')
+    parser.add_argument('--entities', type=int, default=5000)
+    parser.add_argument('--temporal-instances', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.002, help='mock broker latency per request in seconds')
+    parser.add_argument('--page-cap', type=int, default=1000, help='maximum page size the mock broker returns')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--reads', type=int, default=2000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--writes', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--export-entities', type=int, default=20)
+    parser.add_argument('--export-batch-size', type=int, default=500)
+    parser.add_argument('--token-lifetime', type=int, default=7, help='token lifetime in seconds, the client renews 5 seconds early')
+    parser.add_argument('--token-duration', type=float, default=5.0, help='seconds the token expiry scenario runs')
+    parser.add_argument('--memory', action='store_true', help='track peak python allocations per scenario with tracemalloc, this slows every scenario down considerably')
+    parser.add_argument('--in-process', action='store_true', help='run every scenario in this process, max_rss_kb is then the process-wide high-water mark')
+    parser.add_argument('--output', help='write results as json, e.g. to compare runs')
+    parser.add_argument('--compare', help='json results of an earlier run to compare against')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario '+name)
+    if not args.scenarios:
+        args.scenarios = list(SCENARIOS)
+
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('ngsildclient').setLevel(logging.ERROR)
+
+    broker = MockBroker(args.entities, args.temporal_instances, args.latency, args.page_cap, args.error_rate, args.token_lifetime).start()
+    try:
+        run = run_scenario if args.in_process else run_isolated
+        results = {name: run(name, broker, args) for name in args.scenarios}
+    finally:
+        broker.stop()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
 from ngsildclient import ContextBrokerClient
 from dotenv import load_dotenv
+import logging
 import os
 
 load_dotenv()
 
+logging.basicConfig(format='%(message)s')
+logging.getLogger('ngsildclient').setLevel(logging.DEBUG)
+
 scorpio = ContextBrokerClient(
     base_url=os.environ.get('SCORPIO_BASE_URL'),
     tenant=os.environ.get('SCORPIO_TENANT'),
@@ -1,24 +1,1602 @@
 import requests
 from keycloak import KeycloakOpenID
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import time
+import logging
+import os
+import hashlib
+import codecs
+import gzip
+import random
+import contextlib
+import copy
+from bisect import bisect_left
+from email.utils import parsedate_to_datetime
+from collections import deque, OrderedDict
+from urllib.parse import urlencode, quote
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+import threading
+import queue
+import asyncio
+import socket
+import sqlite3
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import httpx
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # None = 'https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context-v1.8.jsonld'
+NGSI_LD_CORE_CONTEXT = 'https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context-v1.8.jsonld'
 
 COLOR_JSON = True
 
+logger = logging.getLogger('ngsildclient')
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 if COLOR_JSON:
     from pygments import highlight
     from pygments.lexers import JsonLexer
     from pygments.formatters import TerminalFormatter
 
-class ContextBrokerClient:
+class _DownloadCheckpoint:
+
+    # an append-only journal of json lines, one per listed type, page offset or completed entity,
+    # compacted when it is loaded so progress costs one short write whatever the number of entities
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.offsets = {}
+        self.completed = set()
+        self.types = {}
+        self.journal = None
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                for line in checkpoint_file:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # the last line is torn when a run was killed while writing it
+                        pass
+            logger.info('⏯  resuming from checkpoint %s, %d entities completed', path, len(self.completed))
+            self._compact()
+
+    def _apply(self, record):
+        if 'type' in record:
+            self.types[record['type']] = record['entities']
+        elif record.get('completed'):
+            self.completed.add(record['id'])
+            self.offsets.pop(record['id'], None)
+        elif record['id'] not in self.completed:
+            self.offsets[record['id']] = record['offset']
+
+    def _compact(self):
+        records = [{'type': t, 'entities': e} for t, e in self.types.items()]
+        records.extend({'id': entity_id, 'completed': True} for entity_id in self.completed)
+        records.extend({'id': entity_id, 'offset': offset} for entity_id, offset in self.offsets.items())
+        tmp_path = self.path+'.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            checkpoint_file.writelines(json.dumps(record)+'\n' for record in records)
+        os.replace(tmp_path, self.path)
+
+    def is_completed(self, entity_id) -> bool:
+        return entity_id in self.completed
+
+    def offset(self, entity_id) -> int:
+        return self.offsets.get(entity_id, 0)
+
+    def type_entities(self, entity_type):
+        # the entity ids of a type whose listing was already exported, None when it still has to be listed
+        return self.types.get(entity_type)
+
+    def set_type_entities(self, entity_type, entity_ids):
+        self._append({'type': entity_type, 'entities': entity_ids})
+
+    def set_offset(self, entity_id, offset:int):
+        self._append({'id': entity_id, 'offset': offset})
+
+    def set_completed(self, entity_id):
+        self._append({'id': entity_id, 'completed': True})
+
+    def remove(self):
+        with self.lock:
+            self.offsets = {}
+            self.completed = set()
+            self.types = {}
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _append(self, record):
+        with self.lock:
+            self._apply(record)
+            if not self.path:
+                return
+            if self.journal is None:
+                self.journal = open(self.path, 'a')
+            self.journal.write(json.dumps(record)+'\n')
+            self.journal.flush()
+
+class TemporalWriter:
+
+    _FLUSH = object()
+    _CLOSE = object()
+
+    def __init__(self, client, tenant=None, context=None, max_batch_samples=5000, flush_interval=1.0, max_queue_size=100000, workers=4, retry:int=0, verbose=False) -> None:
+        self.client = client
+        self.tenant = tenant
+        self.context = context
+        self.max_batch_samples = max_batch_samples
+        self.flush_interval = flush_interval
+        self.retry = retry
+        self.verbose = verbose
+        self.samples_sent = 0
+        self.samples_failed = 0
+        self.last_error = None
+        self.stats_lock = threading.Lock()
+        self.closed = False
+        # appenders block once the queue is full, that is the backpressure towards the producers
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = []
+        self.thread = threading.Thread(target=self._run, name='ngsild-temporal-writer', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, entity_id, attr_name, value, observed_at=None, attr_type='Property', timeout=None):
+        if self.closed:
+            raise RuntimeError('temporal writer is closed')
+        if observed_at is None:
+            observed_at = datetime.now(timezone.utc)
+        if isinstance(observed_at, datetime):
+            observed_at = observed_at.isoformat().replace('+00:00', 'Z')
+        instance = {'type': attr_type, 'value': value, 'observedAt': observed_at}
+        self.queue.put((entity_id, attr_name, instance), timeout=timeout)
+
+    def flush(self):
+        flushed = threading.Event()
+        self.queue.put((self._FLUSH, flushed))
+        flushed.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put((self._CLOSE, None))
+        self.thread.join()
+        self.pool.shutdown()
+
+    def _run(self):
+        buffer = {}
+        buffered = 0
+        flush_at = time.monotonic()+self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0, flush_at-time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item and item[0] is not self._FLUSH and item[0] is not self._CLOSE:
+                entity_id, attr_name, instance = item
+                buffer.setdefault(entity_id, {}).setdefault(attr_name, []).append(instance)
+                buffered += 1
+                if buffered < self.max_batch_samples:
+                    continue
+            if buffered:
+                self._send(buffer)
+                buffer = {}
+                buffered = 0
+            flush_at = time.monotonic()+self.flush_interval
+            if item and item[0] is self._FLUSH:
+                self._wait_in_flight()
+                item[1].set()
+            elif item and item[0] is self._CLOSE:
+                self._wait_in_flight()
+                return
+
+    def _send(self, buffer):
+        # one batch stays on the wire while the next one is being buffered
+        self._wait_in_flight()
+        self.in_flight = [self.pool.submit(self._append_entity, entity_id, attrs) for entity_id, attrs in buffer.items()]
+
+    def _wait_in_flight(self):
+        # _append_entity records its own failures, nothing raised here may stop the writer thread
+        for future in self.in_flight:
+            try:
+                future.result()
+            except Exception:
+                logger.exception('temporal append failed')
+        self.in_flight = []
+
+    def _append_entity(self, entity_id, attrs):
+        sample_count = sum(len(instances) for instances in attrs.values())
+        if not self.context:
+            attrs = {**attrs, '@context': NGSI_LD_CORE_CONTEXT}
+        try:
+            success, status, _, content = self.client.post('temporal/entities/'+quote(entity_id, safe=':')+'/attrs', tenant=self.tenant, context=self.context, data=attrs, retry=self.retry, verbose=self.verbose)
+            # a 404 means the entity does not exist, its samples were dropped and not appended
+            success = success and status != 404
+        except Exception as e:
+            # also covers unserialisable values and an open circuit, the samples are counted as failed
+            success, status, content = False, None, repr(e)
+        with self.stats_lock:
+            if success:
+                self.samples_sent += sample_count
+            else:
+                self.samples_failed += sample_count
+                self.last_error = (entity_id, status, content)
+        if not success and self.verbose:
+            logger.warning('🚨 failed to append %d samples to %s: %s', sample_count, entity_id, status)
+
+def _parse_time(value) -> datetime:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def _format_time(value:datetime) -> str:
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.')+'%03dZ' % (value.microsecond//1000)
+
+class KeycloakTokenManager:
+
+    def __init__(self, keycloak_url, keycloak_realm, client_id, client_secret_key=None, token_grant_type="client_credentials", refresh_margin=30, background_refresh=True, verify=False) -> None:
+        self.keycloak_openid = KeycloakOpenID(server_url=keycloak_url, client_id=client_id, client_secret_key=client_secret_key, realm_name=keycloak_realm, verify=verify)
+        self.token_grant_type = token_grant_type
+        self.refresh_margin = refresh_margin
+        self.background_refresh = background_refresh
+        self.token_refreshes = 0
+        # (access_token, expires_at, refresh_token, refresh_expires_at) is swapped as a whole so readers never need the lock
+        self.token = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def get_token(self) -> str:
+        token = self.token
+        if token and time.monotonic() < token[1]:
+            return token[0]
+        # concurrent callers wait for the single refresh in flight instead of each calling keycloak
+        with self.lock:
+            token = self.token
+            if not token or time.monotonic() >= token[1]:
+                token = self._refresh()
+        return token[0]
+
+    async def async_get_token(self) -> str:
+        token = self.token
+        if token and time.monotonic() < token[1]:
+            return token[0]
+        return await asyncio.to_thread(self.get_token)
+
+    def stop(self):
+        self.stopped.set()
+
+    def _refresh(self):
+        now = time.monotonic()
+        token = self.token
+        token_data = None
+        if token and token[2] and now < token[3]:
+            try:
+                token_data = self.keycloak_openid.refresh_token(token[2])
+            except Exception as e:
+                logger.warning('🔑 token refresh failed, requesting a new token: %s', e)
+        if not token_data:
+            token_data = self.keycloak_openid.token(grant_type=self.token_grant_type)
+        expires_in = int(token_data['expires_in'])
+        refresh_expires_in = int(token_data.get('refresh_expires_in') or 0)
+        self.token = (
+            token_data['access_token'],
+            now + max(expires_in-5, 0),
+            token_data.get('refresh_token'),
+            now + max(refresh_expires_in-5, 0),
+        )
+        self.token_refreshes += 1
+        logger.info('🔑 got new token, expires in %d sec', expires_in)
+        if self.background_refresh and not self.thread:
+            self.thread = threading.Thread(target=self._refresh_loop, name='ngsild-token-refresh', daemon=True)
+            self.thread.start()
+        return self.token
+
+    def _refresh_delay(self) -> float:
+        remaining = self.token[1]-time.monotonic()
+        return max(remaining-min(self.refresh_margin, remaining/2), 1)
+
+    def _refresh_loop(self):
+        delay = self._refresh_delay()
+        while not self.stopped.wait(delay):
+            try:
+                with self.lock:
+                    self._refresh()
+                delay = self._refresh_delay()
+            except Exception as e:
+                logger.warning('🔑 background token refresh failed: %s', e)
+                delay = 5
+
+class RequestTemplate:
+
+    def __init__(self, client, url, tenant, context, accept, params=None) -> None:
+        self.client = client
+        self.base_url = url
+        self.tenant = tenant
+        self.context = context
+        self.accept = accept
+        self.params = params or {}
+        # each fixed parameter is encoded once, a call only encodes its own overrides
+        self.encoded = {name: client._query_string({name: value})[1:] for name, value in self.params.items()}
+        self.url = url+client._query_string(self.params)
+
+    def get(self, params=None, print_response=False, verbose=False):
+        # headers come from the client's header cache
+        url = self.url
+        if params:
+            parts = [encoded for name, encoded in self.encoded.items() if encoded and name not in params]
+            overrides = self.client._query_string(params)[1:]
+            if overrides:
+                parts.append(overrides)
+            url = self.base_url+('?'+'&'.join(parts) if parts else '')
+        return self.client.get(url, tenant=self.tenant, context=self.context, accept=self.accept, print_response=print_response, verbose=verbose)
+
+class ResponseCache:
+
+    def __init__(self, ttl=5.0, max_entries=1024, max_bytes=64*1024*1024) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def get(self, key):
+        # returns the cached (json_data, content, headers) while it is fresh, the parsed body is shared between callers
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.monotonic() < entry[0]:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def conditional_headers(self, key) -> dict:
+        with self.lock:
+            entry = self.entries.get(key)
+        if not entry:
+            return {}
+        conditional_headers = {}
+        response_headers = entry[1][2]
+        if response_headers.get('ETag'):
+            conditional_headers['If-None-Match'] = response_headers['ETag']
+        if response_headers.get('Last-Modified'):
+            conditional_headers['If-Modified-Since'] = response_headers['Last-Modified']
+        return conditional_headers
+
+    def revalidated(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            self.entries[key] = (time.monotonic()+self.ttl, entry[1])
+            self.entries.move_to_end(key)
+            self.revalidations += 1
+            return entry[1]
+
+    def put(self, key, json_data, content, headers):
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry:
+                self.size -= len(old_entry[1][1])
+            if len(content) > self.max_bytes:
+                return
+            self.entries[key] = (time.monotonic()+self.ttl, (json_data, content, headers))
+            self.size += len(content)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted[1])
+
+    def invalidate(self, url_prefix=None):
+        with self.lock:
+            if url_prefix is None:
+                self.entries.clear()
+                self.size = 0
+                return
+            for key in [k for k in self.entries if k[0].startswith(url_prefix)]:
+                self.size -= len(self.entries.pop(key)[1][1])
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'revalidations': self.revalidations, 'entries': len(self.entries), 'bytes': self.size}
+
+class ContextRegistry:
+
+    INDEX_VERSION = 1
+
+    def __init__(self, cache_dir=None, offline=False, preload_dir=None, timeout=30) -> None:
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.cache', 'ngsildclient', 'contexts')
+        self.offline = offline
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.documents = {}
+        self.expansion_tables = {}
+        self.compaction_tables = {}
+        self.index = self._load_index(self.cache_dir)
+        self.session = None
+        if preload_dir:
+            self.preload(preload_dir)
+
+    def _load_index(self, directory) -> dict:
+        index_path = os.path.join(directory, 'index.json')
+        if os.path.exists(index_path):
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+            if index.get('version') == self.INDEX_VERSION:
+                return index['contexts']
+            logger.warning('⚠️  ignoring context cache index %s with version %s', index_path, index.get('version'))
+        return {}
+
+    def _save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        index_path = os.path.join(self.cache_dir, 'index.json')
+        with open(index_path+'.tmp', 'w') as index_file:
+            json.dump({'version': self.INDEX_VERSION, 'contexts': self.index}, index_file, indent=2)
+        os.replace(index_path+'.tmp', index_path)
+
+    def preload(self, directory):
+        # loads a copy of a context cache directory, e.g. one populated on a connected node, for air-gapped use,
+        # the documents are only kept in memory so neither directory nor cache_dir has to be writable
+        with self.lock:
+            for url, entry in self._load_index(directory).items():
+                with open(os.path.join(directory, entry['file'])) as document_file:
+                    self.documents[url] = json.load(document_file)
+                self.expansion_tables.pop(url, None)
+                self.compaction_tables.pop(url, None)
+
+    def add(self, url, document):
+        with self.lock:
+            self._store(url, document)
+
+    def _store(self, url, document):
+        file_name = hashlib.sha1(url.encode('utf-8')).hexdigest()+'.jsonld'
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, file_name), 'w') as document_file:
+            json.dump(document, document_file)
+        self.index[url] = {'file': file_name, 'fetched_at': datetime.now(timezone.utc).isoformat()}
+        self.documents[url] = document
+        self.expansion_tables.pop(url, None)
+        self.compaction_tables.pop(url, None)
+        self._save_index()
+
+    def resolve(self, url) -> dict:
+        document = self.documents.get(url)
+        if document is not None:
+            return document
+        with self.lock:
+            if url in self.documents:
+                return self.documents[url]
+            entry = self.index.get(url)
+            if entry:
+                with open(os.path.join(self.cache_dir, entry['file'])) as document_file:
+                    self.documents[url] = json.load(document_file)
+                return self.documents[url]
+            if self.offline:
+                raise KeyError('context '+url+' is not cached and the registry is offline')
+            if not self.session:
+                self.session = requests.Session()
+            logger.info('⏬ fetching context %s', url)
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            self._store(url, response.json())
+            return self.documents[url]
+
+    def expansion_table(self, url) -> dict:
+        table = self.expansion_tables.get(url)
+        if table is None:
+            table = {}
+            self._collect_terms(url, table, set())
+            # expand compact IRIs like "schema:name" using the prefixes defined in the same context
+            for term, iri in table.items():
+                prefix, _, suffix = iri.partition(':')
+                if suffix and not suffix.startswith('//') and prefix in table:
+                    table[term] = table[prefix]+suffix
+            self.expansion_tables[url] = table
+        return table
+
+    def compaction_table(self, url) -> dict:
+        table = self.compaction_tables.get(url)
+        if table is None:
+            table = {}
+            for term, iri in self.expansion_table(url).items():
+                table.setdefault(iri, term)
+            self.compaction_tables[url] = table
+        return table
+
+    def _collect_terms(self, context, table, visited):
+        if isinstance(context, str):
+            if context in visited:
+                return
+            visited.add(context)
+            self._collect_terms(self.resolve(context).get('@context', {}), table, visited)
+        elif isinstance(context, list):
+            for item in context:
+                self._collect_terms(item, table, visited)
+        elif isinstance(context, dict):
+            for term, definition in context.items():
+                if term.startswith('@'):
+                    continue
+                iri = definition.get('@id') if isinstance(definition, dict) else definition
+                if isinstance(iri, str):
+                    table[term] = iri
+
+    def expand(self, term, url) -> str:
+        table = self.expansion_table(url)
+        if term in table:
+            return table[term]
+        prefix, _, suffix = term.partition(':')
+        if suffix and prefix in table:
+            return table[prefix]+suffix
+        return term
+
+    def compact(self, iri, url) -> str:
+        return self.compaction_table(url).get(iri, iri)
+
+class JsonCodec:
+
+    def __init__(self, library=None) -> None:
+        # library is 'orjson', 'msgspec' or 'json', by default the fastest installed one is used
+        if not library:
+            library = 'orjson' if orjson else 'msgspec' if msgspec else 'json'
+        if library == 'orjson' and orjson:
+            self.loads = orjson.loads
+            self.dumps = orjson.dumps
+        elif library == 'msgspec' and msgspec:
+            decode = msgspec.json.decode
+            def loads(data):
+                # msgspec.DecodeError is not a ValueError, callers catch ValueError whatever the library
+                try:
+                    return decode(data)
+                except msgspec.DecodeError as e:
+                    raise ValueError(str(e)) from e
+            self.loads = loads
+            self.dumps = msgspec.json.encode
+        elif library == 'json':
+            self.loads = json.loads
+            self.dumps = lambda data: json.dumps(data).encode(encoding='utf-8')
+        else:
+            raise ImportError('json library '+library+' is not installed')
+        self.library = library
+
+class JsonArrayParser:
+
+    def __init__(self) -> None:
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.started = False
+
+    def feed(self, data:bytes, final=False) -> list:
+        # returns the array items completed by this chunk, the rest of the body stays in the buffer
+        self.buffer += self.text_decoder.decode(data, final)
+        items = []
+        position = 0
+        length = len(self.buffer)
+        while True:
+            while position < length and self.buffer[position] in ' \t\r\n,':
+                position += 1
+            if not self.started:
+                if position >= length:
+                    break
+                if self.buffer[position] != '[':
+                    raise ValueError('response body is not a JSON array')
+                self.started = True
+                position += 1
+                continue
+            if position >= length or self.buffer[position] == ']':
+                break
+            try:
+                item, end = self.decoder.raw_decode(self.buffer, position)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break
+            # an item is only complete once its delimiter has arrived, a number cut after '.' or 'e' parses as a prefix
+            delimiter = end
+            while delimiter < length and self.buffer[delimiter] in ' \t\r\n':
+                delimiter += 1
+            if not final and (delimiter >= length or self.buffer[delimiter] not in ',]'):
+                break
+            items.append(item)
+            position = end
+        self.buffer = self.buffer[position:]
+        return items
+
+class Attribute:
+
+    __slots__ = ('type', 'value', 'observed_at', 'unit_code', 'dataset_id', 'properties', 'system_attrs')
+
+    _KEYS = ('type', 'value', 'object', 'languageMap', 'observedAt', 'unitCode', 'datasetId')
+    # system members are kept as they are instead of being read as sub-properties
+    _SYSTEM_KEYS = ('createdAt', 'modifiedAt', 'instanceId')
+
+    def __init__(self, type='Property', value=None, observed_at=None, unit_code=None, dataset_id=None, properties=None, system_attrs=None) -> None:
+        self.type = type
+        self.value = value
+        self.observed_at = observed_at
+        self.unit_code = unit_code
+        self.dataset_id = dataset_id
+        self.properties = properties
+        self.system_attrs = system_attrs
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, list):
+            return [cls.from_dict(d) for d in data]
+        if not isinstance(data, dict) or not ('value' in data or 'object' in data or 'languageMap' in data or 'type' in data):
+            return cls('Property', data)
+        properties = {k: cls.from_dict(v) for k, v in data.items() if k not in cls._KEYS and k not in cls._SYSTEM_KEYS}
+        system_attrs = {k: data[k] for k in cls._SYSTEM_KEYS if k in data}
+        if 'object' in data:
+            value = data['object']
+        else:
+            value = data.get('value', data.get('languageMap'))
+        return cls(data.get('type', 'Relationship' if 'object' in data else 'Property'), value, data.get('observedAt'), data.get('unitCode'), data.get('datasetId'), properties or None, system_attrs or None)
+
+    def to_dict(self) -> dict:
+        data = {'type': self.type, 'object' if self.type == 'Relationship' else 'value': self.value}
+        if self.observed_at:
+            data['observedAt'] = self.observed_at
+        if self.unit_code:
+            data['unitCode'] = self.unit_code
+        if self.dataset_id:
+            data['datasetId'] = self.dataset_id
+        if self.properties:
+            data.update({k: v.to_dict() for k, v in self.properties.items()})
+        if self.system_attrs:
+            data.update(self.system_attrs)
+        return data
+
+    def __repr__(self) -> str:
+        return 'Attribute('+repr(self.type)+', '+repr(self.value)+')'
+
+class Entity:
+
+    __slots__ = ('id', 'type', 'context', 'attrs', 'system_attrs')
+
+    _SYSTEM_KEYS = ('createdAt', 'modifiedAt', 'scope')
+
+    def __init__(self, id, type, attrs=None, context=None, system_attrs=None) -> None:
+        self.id = id
+        self.type = type
+        self.attrs = attrs or {}
+        self.context = context
+        self.system_attrs = system_attrs
+
+    @classmethod
+    def from_dict(cls, data):
+        attrs = {k: Attribute.from_dict(v) for k, v in data.items() if k not in ('id', 'type', '@context') and k not in cls._SYSTEM_KEYS}
+        system_attrs = {k: data[k] for k in cls._SYSTEM_KEYS if k in data}
+        return cls(data.get('id'), data.get('type'), attrs, data.get('@context'), system_attrs or None)
+
+    def to_dict(self) -> dict:
+        data = {'id': self.id, 'type': self.type}
+        if self.system_attrs:
+            data.update(self.system_attrs)
+        for name, attr in self.attrs.items():
+            data[name] = [a.to_dict() for a in attr] if isinstance(attr, list) else attr.to_dict()
+        if self.context:
+            data['@context'] = self.context
+        return data
+
+    def __getitem__(self, name):
+        return self.attrs[name]
+
+    def __repr__(self) -> str:
+        return 'Entity('+repr(self.id)+', '+repr(self.type)+')'
+
+class CircuitOpenError(requests.RequestException):
+    # a RequestException, so callers handling transport failures also handle an open circuit
+    pass
+
+class RetryPolicy:
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, max_attempts=1, base_delay=0.5, max_delay=30.0, retry_statuses=(429, 500, 502, 503, 504), retry_non_idempotent=False, retry_budget=10, retry_budget_ratio=0.2, failure_threshold=20, reset_timeout=30.0) -> None:
+        # one policy is meant to be shared by every client talking to the same broker
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+        self.retry_non_idempotent = retry_non_idempotent
+        self.retry_budget = retry_budget
+        self.retry_budget_ratio = retry_budget_ratio
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.budget = float(retry_budget)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.retries = 0
+
+    def before_request(self):
+        with self.lock:
+            if self.open_until:
+                if time.monotonic() < self.open_until:
+                    raise CircuitOpenError('broker circuit is open after '+str(self.consecutive_failures)+' consecutive failures')
+                # half open, this request probes the broker while everyone else keeps failing fast
+                self.open_until = time.monotonic()+self.reset_timeout
+            # every request earns a fraction of a retry, so retries stay a bounded share of the traffic
+            self.budget = min(self.budget+self.retry_budget_ratio, self.retry_budget)
+
+    def record(self, failed:bool):
+        with self.lock:
+            if failed:
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= self.failure_threshold:
+                    self.open_until = time.monotonic()+self.reset_timeout
+            else:
+                self.consecutive_failures = 0
+                self.open_until = 0.0
+
+    def is_failure(self, status_code) -> bool:
+        return status_code is None or status_code == 429 or status_code >= 500
+
+    def is_retryable(self, method:str, status_code) -> bool:
+        if status_code is not None and status_code not in self.retry_statuses:
+            return False
+        # 429 and 503 mean the broker did not process the request, anything else is only safe to repeat for idempotent verbs
+        if method not in self.IDEMPOTENT_METHODS and not self.retry_non_idempotent and status_code not in (429, 503):
+            return False
+        return True
+
+    def should_retry(self, method:str, status_code) -> bool:
+        if not self.is_retryable(method, status_code):
+            return False
+        with self.lock:
+            if self.budget < 1:
+                return False
+            self.budget -= 1
+            self.retries += 1
+        return True
+
+    def delay(self, attempt:int, retry_after=None, base_delay=None) -> float:
+        if retry_after:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                try:
+                    seconds = (parsedate_to_datetime(retry_after)-datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    seconds = None
+            if seconds is not None:
+                return min(max(seconds, 0), self.max_delay)
+        backoff = min(self.max_delay, (base_delay or self.base_delay)*2**(attempt-1))
+        return random.uniform(0, backoff)
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None) -> None:
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self, tokens=1) -> float:
+        # the balance may go negative, callers then wait their turn in arrival order
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens+(now-self.updated)*self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return -self.tokens/self.rate if self.tokens < 0 else 0
+
+    def acquire(self, tokens=1):
+        delay = self._reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+    async def async_acquire(self, tokens=1):
+        delay = self._reserve(tokens)
+        if delay:
+            await asyncio.sleep(delay)
+
+class AdaptiveConcurrency:
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, latency_target=None, tolerance=2.0, backoff=0.5) -> None:
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self.short_latency = None
+        self.long_latency = None
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+        self.async_waiters = []
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def async_acquire(self):
+        while True:
+            with self.condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self.async_waiters.append((loop, future))
+            # the timeout only guards against a wake up racing with the registration
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(future, 0.1)
+
+    def _is_slow(self, elapsed):
+        if self.latency_target:
+            return elapsed > self.latency_target
+        # a short term average well above the long term one means queues are building up on the broker
+        if self.short_latency is None:
+            self.short_latency = self.long_latency = elapsed
+        self.short_latency += (elapsed-self.short_latency)*0.2
+        self.long_latency += (elapsed-self.long_latency)*0.01
+        return self.short_latency > self.long_latency*self.tolerance
+
+    def release(self, elapsed, congested=False):
+        # AIMD: +1 slot per round of successful requests, halved at most once per round trip on errors or rising latency
+        with self.condition:
+            self.in_flight -= 1
+            slow = self._is_slow(elapsed)
+            now = time.monotonic()
+            if congested or slow:
+                if now-self.last_decrease > (self.short_latency or elapsed):
+                    self.limit = max(self.min_limit, self.limit*self.backoff)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit+1/self.limit)
+            self.condition.notify_all()
+            async_waiters = self.async_waiters
+            self.async_waiters = []
+        for loop, future in async_waiters:
+            loop.call_soon_threadsafe(_wake_future, future)
+
+def _wake_future(future):
+    if not future.done():
+        future.set_result(None)
+
+ENDPOINT_CLASSES = ('query', 'temporal', 'write')
+
+def _endpoint_class(method:str, url:str) -> str:
+    if method not in ('GET', 'HEAD'):
+        return 'write'
+    if '/ngsi-ld/v1/temporal/' in url:
+        return 'temporal'
+    return 'query'
+
+class FlowControl:
+
+    def __init__(self, rate_limits=None, max_concurrency=None, initial_concurrency=4, latency_target=None, tolerance=2.0, backoff=0.5) -> None:
+        # rate_limits and max_concurrency map endpoint classes (query, temporal, write) to requests per second and in-flight requests,
+        # latency_target is either one value in seconds or a dict per class, without it the latency baseline is learned
+        max_concurrency = max_concurrency or {}
+        latency_targets = latency_target if isinstance(latency_target, dict) else {c: latency_target for c in ENDPOINT_CLASSES}
+        self.rate_limiters = {endpoint_class: TokenBucket(rate) for endpoint_class, rate in (rate_limits or {}).items()}
+        self.concurrency = {
+            endpoint_class: AdaptiveConcurrency(initial_concurrency, 1, max_concurrency.get(endpoint_class, 64), latency_targets.get(endpoint_class), tolerance, backoff)
+            for endpoint_class in ENDPOINT_CLASSES
+        }
+
+    def acquire(self, method, url) -> str:
+        # the rate token is taken first so that waiting for it never holds a concurrency slot
+        endpoint_class = _endpoint_class(method, url)
+        rate_limiter = self.rate_limiters.get(endpoint_class)
+        if rate_limiter:
+            rate_limiter.acquire()
+        self.concurrency[endpoint_class].acquire()
+        return endpoint_class
+
+    async def async_acquire(self, method, url) -> str:
+        endpoint_class = _endpoint_class(method, url)
+        rate_limiter = self.rate_limiters.get(endpoint_class)
+        if rate_limiter:
+            await rate_limiter.async_acquire()
+        await self.concurrency[endpoint_class].async_acquire()
+        return endpoint_class
+
+    def release(self, endpoint_class, elapsed, status_code):
+        congested = status_code is None or status_code == 429 or status_code >= 500
+        self.concurrency[endpoint_class].release(elapsed, congested)
+
+    def snapshot(self) -> dict:
+        return {endpoint_class: {'limit': round(c.limit, 2), 'in_flight': c.in_flight} for endpoint_class, c in self.concurrency.items()}
+
+NGSI_LD_COLLECTIONS = ('entities', 'types', 'attributes', 'subscriptions', 'csourceRegistrations', 'jsonldContexts')
+
+def _endpoint(url:str) -> str:
+    # entities/urn:ngsi-ld:Device:1/attrs becomes entities/{id}/attrs so metrics do not explode per entity
+    path = url.split('?', 1)[0]
+    if '/ngsi-ld/v1/' in path:
+        path = path.split('/ngsi-ld/v1/', 1)[1]
+    segments = path.split('/')
+    for i in range(1, len(segments)):
+        if segments[i-1] in NGSI_LD_COLLECTIONS and segments[i] not in ('attrs', ''):
+            segments[i] = '{id}'
+    return '/'.join(segments)
+
+class LatencyHistogram:
+
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+    def __init__(self) -> None:
+        self.counts = [0]*(len(self.BUCKETS_MS)+1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, elapsed_ms:float):
+        self.counts[bisect_left(self.BUCKETS_MS, elapsed_ms)] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def percentile(self, q:float) -> float:
+        # upper bound of the bucket holding the q-th percentile
+        if not self.count:
+            return 0.0
+        rank = q*self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return float(self.BUCKETS_MS[i]) if i < len(self.BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ms/self.count if self.count else 0.0,
+            'p50_ms': self.percentile(0.5),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.max_ms,
+        }
+
+class Instrumentation:
+
+    def __init__(self, tracing=False) -> None:
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {'requests': 0, 'errors': 0, 'retries': 0, 'bytes_sent': 0, 'bytes_received': 0}
+        self.request_hooks = []
+        self.response_hooks = []
+        self.tracer = otel_trace.get_tracer('ngsildclient') if tracing and otel_trace else None
+
+    def add_request_hook(self, hook):
+        # hook(method, url, tenant) is called before every attempt
+        self.request_hooks.append(hook)
+
+    def add_response_hook(self, hook):
+        # hook(method, url, tenant, status_code, elapsed_seconds) is called after every attempt, status_code is None on connection errors
+        self.response_hooks.append(hook)
+
+    def span(self, method, url, tenant):
+        if not self.tracer:
+            return contextlib.nullcontext()
+        return self.tracer.start_as_current_span('NGSI-LD '+method+' '+_endpoint(url), attributes={'http.request.method': method, 'url.full': url, 'ngsild.tenant': tenant or ''})
+
+    def before_request(self, method, url, tenant):
+        for hook in self.request_hooks:
+            try:
+                hook(method, url, tenant)
+            except Exception:
+                logger.exception('request hook failed')
+
+    def after_response(self, method, url, tenant, status_code, elapsed, bytes_sent, bytes_received, span=None):
+        key = (method, _endpoint(url), tenant)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.observe(elapsed*1000)
+            self.counters['requests'] += 1
+            self.counters['bytes_sent'] += bytes_sent
+            self.counters['bytes_received'] += bytes_received
+            if status_code is None or status_code >= 400:
+                self.counters['errors'] += 1
+        if span is not None and status_code is not None:
+            span.set_attribute('http.response.status_code', status_code)
+        for hook in self.response_hooks:
+            try:
+                hook(method, url, tenant, status_code, elapsed)
+            except Exception:
+                logger.exception('response hook failed')
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0)+value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'latency': {' '.join(str(k) for k in key): histogram.to_dict() for key, histogram in self.histograms.items()},
+            }
+
+class _NotificationHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.split('?', 1)[0] != receiver.path:
+            self._reply(404)
+            return
+        try:
+            notification = receiver.codec.loads(body)
+        except ValueError:
+            self._reply(400)
+            return
+        # the broker is acknowledged right away, callbacks run on the dispatcher thread
+        self._reply(204)
+        receiver.receive(notification)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.receiver.verbose:
+            logger.debug('⏪ notification '+format, *args)
+
+class NotificationReceiver:
+
+    _CLOSE = object()
+
+    def __init__(self, host='0.0.0.0', port=0, path='/notify', public_url=None, max_batch_size=100, max_batch_delay=0.5, dedup_size=10000, codec=None, verbose=False) -> None:
+        self.path = path
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.dedup_size = dedup_size
+        self.codec = codec or JsonCodec()
+        self.verbose = verbose
+        self.callbacks = []
+        self.async_queues = []
+        self.seen = OrderedDict()
+        self.seen_lock = threading.Lock()
+        self.subscriptions = {}
+        self.subscriptions_lock = threading.Lock()
+        self.stats = {'notifications': 0, 'entities': 0, 'duplicates': 0, 'batches': 0, 'callback_errors': 0, 'renewals': 0}
+        self.closed = threading.Event()
+        self.queue = queue.Queue()
+
+        self.server = ThreadingHTTPServer((host, port), _NotificationHandler)
+        self.server.daemon_threads = True
+        self.server.receiver = self
+        self.port = self.server.server_address[1]
+        self.url = public_url or 'http://'+socket.gethostname()+':'+str(self.port)+path
+        self.server_thread = threading.Thread(target=self.server.serve_forever, name='ngsild-notification-server', daemon=True)
+        self.server_thread.start()
+        self.dispatcher = threading.Thread(target=self._run, name='ngsild-notification-dispatcher', daemon=True)
+        self.dispatcher.start()
+        self.renewer = None
+        if verbose:
+            logger.info('⏪ listening for notifications on %s', self.url)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_callback(self, callback):
+        # callback(subscription_id, entities) is called on the dispatcher thread with at most max_batch_size entities
+        self.callbacks.append(callback)
+
+    def async_queue(self, maxsize=0) -> asyncio.Queue:
+        # must be called from the event loop that consumes the queue, it receives (subscription_id, entities) tuples
+        async_queue = asyncio.Queue(maxsize=maxsize)
+        self.async_queues.append((asyncio.get_running_loop(), async_queue))
+        return async_queue
+
+    def receive(self, notification):
+        # a broker retrying a notification, or overlapping subscriptions, must not dispatch the same change twice
+        subscription_id = notification.get('subscriptionId')
+        fresh = []
+        with self.seen_lock:
+            self.stats['notifications'] += 1
+            for entity in notification.get('data', []):
+                key = self._dedup_key(subscription_id, entity)
+                if key in self.seen:
+                    self.seen.move_to_end(key)
+                    self.stats['duplicates'] += 1
+                    continue
+                self.seen[key] = None
+                if len(self.seen) > self.dedup_size:
+                    self.seen.popitem(last=False)
+                fresh.append(entity)
+        if fresh:
+            self.queue.put((subscription_id, fresh))
+
+    def _dedup_key(self, subscription_id, entity):
+        modified_at = entity.get('modifiedAt')
+        if modified_at:
+            return (subscription_id, entity.get('id'), modified_at)
+        return (subscription_id, hashlib.sha1(self.codec.dumps(entity)).digest())
 
-    def __init__(self, base_url=None, tenant=None, add_tenant_to_path=False, keycloak_url=None, keycloak_realm=None, client_id=None, client_secret_key=None, token_grant_type="client_credentials") -> None:
+    def _run(self):
+        batches = {}
+        batched = 0
+        flush_at = None
+        while True:
+            timeout = None if flush_at is None else max(0, flush_at-time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item and item[0] is not self._CLOSE:
+                subscription_id, entities = item
+                batches.setdefault(subscription_id, []).extend(entities)
+                batched += len(entities)
+                if flush_at is None:
+                    flush_at = time.monotonic()+self.max_batch_delay
+                if batched < self.max_batch_size:
+                    continue
+            for subscription_id, entities in batches.items():
+                for start in range(0, len(entities), self.max_batch_size):
+                    self._dispatch(subscription_id, entities[start:start+self.max_batch_size])
+            batches = {}
+            batched = 0
+            flush_at = None
+            if item and item[0] is self._CLOSE:
+                return
+
+    def _dispatch(self, subscription_id, entities):
+        self.stats['batches'] += 1
+        self.stats['entities'] += len(entities)
+        for callback in self.callbacks:
+            try:
+                callback(subscription_id, entities)
+            except Exception:
+                self.stats['callback_errors'] += 1
+                logger.exception('notification callback failed')
+        for loop, async_queue in self.async_queues:
+            loop.call_soon_threadsafe(async_queue.put_nowait, (subscription_id, entities))
+
+    def track(self, client, subscription_id, tenant=None, ttl=timedelta(hours=1)):
+        # tracked subscriptions are renewed at half their lifetime and deleted when the receiver is closed
+        with self.subscriptions_lock:
+            self.subscriptions[subscription_id] = (client, tenant, ttl, time.monotonic()+ttl.total_seconds()/2)
+            if self.renewer is None:
+                self.renewer = threading.Thread(target=self._renew_loop, name='ngsild-subscription-renewer', daemon=True)
+                self.renewer.start()
+
+    def _renew_loop(self):
+        while not self.closed.wait(1.0):
+            now = time.monotonic()
+            with self.subscriptions_lock:
+                due = [(subscription_id, s) for subscription_id, s in self.subscriptions.items() if s[3] <= now]
+            for subscription_id, (client, tenant, ttl, _) in due:
+                expires_at = datetime.now(timezone.utc)+ttl
+                try:
+                    success = client.renew_subscription(subscription_id, expires_at, tenant=tenant, verbose=self.verbose)
+                except Exception as e:
+                    # the renewer must outlive any failure, otherwise every tracked subscription silently expires
+                    logger.warning('🚨 failed to renew subscription %s: %s', subscription_id, e)
+                    success = False
+                # a failed renewal is retried on the next tick, the subscription is still valid for the other half of its lifetime
+                retry_at = now+ttl.total_seconds()/2 if success else now+min(30, ttl.total_seconds()/10)
+                with self.subscriptions_lock:
+                    if subscription_id in self.subscriptions:
+                        self.subscriptions[subscription_id] = (client, tenant, ttl, retry_at)
+                if success:
+                    self.stats['renewals'] += 1
+
+    def close(self, delete_subscriptions=True):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        if delete_subscriptions:
+            for subscription_id, (client, tenant, _, _) in list(self.subscriptions.items()):
+                try:
+                    client.delete_subscription(subscription_id, tenant=tenant, verbose=self.verbose)
+                except requests.RequestException as e:
+                    logger.warning('🚨 failed to delete subscription %s: %s', subscription_id, e)
+        self.subscriptions = {}
+        self.server.shutdown()
+        self.server.server_close()
+        self.queue.put((self._CLOSE, None))
+        self.dispatcher.join()
+
+class EntityMirror:
+
+    def __init__(self, client, types, context=None, attrs=None, query_params=None, path=None, page_size=1000, overlap=timedelta(seconds=1), full_sync_interval=timedelta(hours=1), verbose=False) -> None:
+        self.client = client
+        self.types = [types] if isinstance(types, str) else list(types)
+        self.context = context
+        self.attrs = attrs
+        self.query_params = query_params
+        self.page_size = page_size
+        self.overlap = overlap
+        self.full_sync_interval = full_sync_interval
+        self.verbose = verbose
+        self.lock = threading.RLock()
+        self.entities = {}
+        self.type_index = {}
+        self.attr_index = {}
+        self.value_index = {}
+        self.modified_at = None
+        self.last_full_sync = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.path = path
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS entities (id TEXT PRIMARY KEY, type TEXT, modified_at TEXT, data BLOB)')
+            self._load_db()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, entity_id):
+        return entity_id in self.entities
+
+    def get(self, entity_id):
+        return self.entities.get(entity_id)
+
+    def by_type(self, type_name) -> list:
+        with self.lock:
+            return [self.entities[entity_id] for entity_id in self.type_index.get(type_name, ())]
+
+    def find(self, attr_name, value=None) -> list:
+        # without a value every entity having the attribute is returned, otherwise only exact matches of a scalar value
+        with self.lock:
+            if value is None:
+                entity_ids = self.attr_index.get(attr_name, ())
+            else:
+                entity_ids = self.value_index.get((attr_name, value), ())
+            return [self.entities[entity_id] for entity_id in entity_ids]
+
+    def _load_db(self):
+        for entity_id, modified_at, data in self.db.execute('SELECT id, modified_at, data FROM entities'):
+            self._put(self.client.codec.loads(data))
+            if modified_at and (self.modified_at is None or _parse_time(modified_at) > self.modified_at):
+                self.modified_at = _parse_time(modified_at)
+        if self.entities:
+            # a restored mirror only needs deltas, the next full load happens after full_sync_interval
+            self.last_full_sync = time.monotonic()
+        if self.verbose:
+            logger.info('⏪ %d entities restored from %s', len(self.entities), self.path)
+
+    def _modified_at(self, entity):
+        # brokers only return modifiedAt with options=sysAttrs, the entity level value is missing on some of them
+        modified_at = entity.get('modifiedAt')
+        if modified_at:
+            return modified_at
+        attr_times = [attr.get('modifiedAt') for attr in entity.values() if isinstance(attr, dict) and attr.get('modifiedAt')]
+        return max(attr_times, key=_parse_time) if attr_times else None
+
+    def _attr_value(self, attr):
+        if isinstance(attr, dict):
+            return attr.get('value', attr.get('object'))
+        return attr
+
+    def _index(self, entity, add):
+        entity_id = entity['id']
+        for type_name in entity['type'] if isinstance(entity.get('type'), list) else [entity.get('type')]:
+            self._index_key(self.type_index, type_name, entity_id, add)
+        for attr_name, attr in entity.items():
+            if attr_name in ('id', 'type', '@context', 'createdAt', 'modifiedAt'):
+                continue
+            self._index_key(self.attr_index, attr_name, entity_id, add)
+            value = self._attr_value(attr)
+            try:
+                self._index_key(self.value_index, (attr_name, value), entity_id, add)
+            except TypeError:
+                pass
+
+    def _index_key(self, index, key, entity_id, add):
+        if add:
+            index.setdefault(key, set()).add(entity_id)
+            return
+        entity_ids = index.get(key)
+        if entity_ids is not None:
+            entity_ids.discard(entity_id)
+            if not entity_ids:
+                del index[key]
+
+    def _put(self, entity):
+        previous = self.entities.get(entity['id'])
+        if previous is not None:
+            self._index(previous, False)
+        self.entities[entity['id']] = entity
+        self._index(entity, True)
+
+    def _remove(self, entity_id):
+        previous = self.entities.pop(entity_id, None)
+        if previous is not None:
+            self._index(previous, False)
+
+    def apply(self, entities, deleted_ids=()):
+        # also usable as a NotificationReceiver callback through on_notification
+        rows = []
+        with self.lock:
+            for entity in entities:
+                entity = entity.to_dict() if isinstance(entity, Entity) else entity
+                modified_at = self._modified_at(entity)
+                self._put(entity)
+                if modified_at and (self.modified_at is None or _parse_time(modified_at) > self.modified_at):
+                    self.modified_at = _parse_time(modified_at)
+                if self.db:
+                    rows.append((entity['id'], entity.get('type') if isinstance(entity.get('type'), str) else None, modified_at, self.client.codec.dumps(entity)))
+            for entity_id in deleted_ids:
+                self._remove(entity_id)
+            if self.db:
+                with self.db:
+                    self.db.executemany('INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)', rows)
+                    self.db.executemany('DELETE FROM entities WHERE id = ?', [(entity_id,) for entity_id in deleted_ids])
+        return len(entities)
+
+    def on_notification(self, subscription_id, entities):
+        self.apply(entities)
+
+    def _query_params(self, since=None):
+        params = {'options': 'sysAttrs'}
+        if since:
+            params.update({'timerel': 'after', 'timeAt': _format_time(since), 'timeproperty': 'modifiedAt'})
+        if self.query_params:
+            params.update(self.query_params)
+        return params
+
+    def _fetch(self, since=None):
+        for type_name in self.types:
+            request_path = self.client._entities_path(type_name, self.attrs, self._query_params(since))
+            yield from self.client._iter_pages(request_path, context=self.context, page_size=self.page_size)
+
+    def load(self):
+        # a full load replaces the mirror content, entities deleted on the broker disappear from it
+        started = time.monotonic()
+        loaded = set()
+        batch = []
+        for entity in self._fetch():
+            batch.append(entity)
+            if len(batch) >= self.page_size:
+                self.apply(batch)
+                loaded.update(e['id'] for e in batch)
+                batch = []
+        self.apply(batch)
+        loaded.update(e['id'] for e in batch)
+        # a failed page raises out of _fetch, so deletions are only derived from a scan that completed
+        with self.lock:
+            deleted_ids = [entity_id for entity_id in self.entities if entity_id not in loaded]
+        self.apply([], deleted_ids)
+        self.last_full_sync = time.monotonic()
+        if self.verbose:
+            logger.info('⏪ mirror loaded %d entities, %d removed in %.2f sec', len(loaded), len(deleted_ids), time.monotonic()-started)
+        return len(loaded)
+
+    def sync(self):
+        # deletions are invisible to modifiedAt queries, a periodic full load removes them
+        if self.modified_at is None or self.last_full_sync is None or self._full_sync_due():
+            return self.load()
+        since = self.modified_at-self.overlap
+        batch = list(self._fetch(since))
+        self.apply(batch)
+        if self.verbose:
+            logger.debug('⏪ mirror synced %d entities modified after %s', len(batch), _format_time(since))
+        return len(batch)
+
+    def _full_sync_due(self):
+        if not self.full_sync_interval:
+            return False
+        return time.monotonic()-self.last_full_sync >= self.full_sync_interval.total_seconds()
+
+    def start(self, interval=10.0):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, args=(interval,), name='ngsild-entity-mirror', daemon=True)
+        self.thread.start()
+
+    def _run(self, interval):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                # the mirror keeps its current content and the next tick tries again
+                logger.warning('🚨 mirror sync failed: %r', e)
+            if self.stop_event.wait(interval):
+                return
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def close(self):
+        self.stop()
+        if self.db:
+            self.db.close()
+            self.db = None
+
+class FanOutTarget:
+
+    def __init__(self, client, tenant=None, name=None, token_manager=None, rate_limit=None, pool_size=4) -> None:
+        # every target gets its own client copy, so pools, tokens and tenants never leak between targets
+        self.client = copy.copy(client)
+        self.client.tenant = tenant or client.tenant
+        self.client.session = requests.Session()
+        self.client.set_pool_size(pool_size)
+        self.client._header_cache = {}
+        if token_manager:
+            self.client.token_manager = token_manager
+        if rate_limit:
+            self.client.rate_limiter = TokenBucket(rate_limit)
+        self.tenant = self.client.tenant
+        self.name = name or client.base_url+('#'+self.tenant if self.tenant else '')
+
+    def close(self):
+        self.client.session.close()
+
+class FanOut:
+
+    _DONE = object()
+
+    def __init__(self, targets, workers=16, verbose=False) -> None:
+        self.targets = [t if isinstance(t, FanOutTarget) else FanOutTarget(*t) if isinstance(t, tuple) else FanOutTarget(t) for t in targets]
+        self.workers = workers
+        self.verbose = verbose
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for target in self.targets:
+            target.close()
+
+    def iter_map(self, fn):
+        # yields (target name, result, error) as soon as each target answers
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(self.targets)) or 1) as pool:
+            futures = {pool.submit(fn, target.client): target for target in self.targets}
+            for future in as_completed(futures):
+                target = futures[future]
+                try:
+                    yield (target.name, future.result(), None)
+                except Exception as e:
+                    if self.verbose:
+                        logger.warning('🚨 %s failed: %s', target.name, e)
+                    yield (target.name, None, e)
+
+    def map(self, fn):
+        # fn(client) runs once per target, returns ({name: result}, {name: error})
+        started = time.monotonic()
+        results = {}
+        errors = {}
+        for name, result, error in self.iter_map(fn):
+            if error is None:
+                results[name] = result
+            else:
+                errors[name] = error
+        if self.verbose:
+            logger.info('⏪ %d targets answered, %d failed in %.2f sec', len(results), len(errors), time.monotonic()-started)
+        return (results, errors)
+
+    def stream(self, fn, max_buffer=1000):
+        # fn(client) returns an iterable, items are yielded as (target name, item) while targets are still paging
+        # errors are yielded as (target name, exception) once the target stops
+        items = queue.Queue(maxsize=max_buffer)
+        stopped = threading.Event()
+        def put(entry):
+            # a consumer that stops iterating early must not leave producers blocked on a full buffer
+            while not stopped.is_set():
+                try:
+                    items.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def drain(target):
+            try:
+                for item in fn(target.client):
+                    if not put((target.name, item)):
+                        return
+            except Exception as e:
+                if self.verbose:
+                    logger.warning('🚨 %s failed: %s', target.name, e)
+                put((target.name, e))
+            finally:
+                put((target.name, self._DONE))
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(self.targets)) or 1) as pool:
+            for target in self.targets:
+                pool.submit(drain, target)
+            pending = len(self.targets)
+            try:
+                while pending:
+                    name, item = items.get()
+                    if item is self._DONE:
+                        pending -= 1
+                        continue
+                    yield (name, item)
+            finally:
+                stopped.set()
+
+    def _merged(self, results, merge):
+        if not merge:
+            return results
+        return [(name, item) for name, result in results.items() for item in result or []]
+
+    def get_types(self, context=None, merge=False):
+        results, errors = self.map(lambda client: client.get_types(context=context))
+        return (self._merged(results, merge), errors)
+
+    def get_entities_by_type(self, type_name, context=None, sdm_model=None, attrs=None, merge=False):
+        results, errors = self.map(lambda client: client.get_entities_by_type(type_name, context, sdm_model, attrs))
+        return (self._merged(results, merge), errors)
+
+    def iter_entities(self, type_name, context=None, sdm_model=None, attrs=None, query_params=None, page_size=1000, max_buffer=1000):
+        return self.stream(lambda client: client.iter_entities(type_name, context, sdm_model, attrs, query_params, page_size), max_buffer)
+
+    def get_temporal_entities_by_type(self, type_name, context=None, sdm_model=None, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None, merge=False):
+        results, errors = self.map(lambda client: client.get_temporal_entities_by_type(type_name, context, sdm_model, attrs, last_n, format, from_time, to_time, query_params))
+        return (self._merged(results, merge), errors)
+
+    def iter_temporal_entities(self, type_name, context=None, sdm_model=None, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None, page_size=100, max_buffer=1000):
+        return self.stream(lambda client: client.iter_temporal_entities(type_name, context, sdm_model, attrs, last_n, format, from_time, to_time, query_params, page_size), max_buffer)
+
+class _ContextBrokerClientBase:
+    # URL, header, path and result helpers shared by the sync and async clients, none of them does I/O
+
+    def __init__(self, base_url=None, tenant=None, add_tenant_to_path=False, keycloak_url=None, keycloak_realm=None, client_id=None, client_secret_key=None, token_grant_type="client_credentials", token_manager=None, response_cache=None, context_registry=None, codec=None, response_mode='full', typed_entities=False, retry_policy=None, instrumentation=None, flow_control=None) -> None:
         if base_url.endswith('/ngsi-ld/v1/'):
             base_url = base_url[0:-len('/ngsi-ld/v1/')]
         elif base_url.endswith('/'):
@@ -27,45 +1605,65 @@ class ContextBrokerClient:
         self.tenant = tenant
         self.add_tenant_to_path = add_tenant_to_path
 
-        self.session = requests.Session()
+        # the session is created by the sync and async clients
+        self._header_cache = {}
+        self.response_cache = response_cache
+        self.context_registry = context_registry
+        self.codec = codec or JsonCodec()
+        # 'full' returns (json, content, headers), 'json' drops the raw content and 'raw' skips parsing
+        self.response_mode = response_mode
+        self.typed_entities = typed_entities
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.instrumentation = instrumentation or Instrumentation()
+        self.rate_limiter = None
+        self.flow_control = flow_control
 
-        self.token_expire = datetime.now()
-        self.token = None
-        if keycloak_url:
-            self.keycloak_openid = KeycloakOpenID(server_url=keycloak_url, client_id=client_id, client_secret_key=client_secret_key, realm_name=keycloak_realm, verify=False)
-            self.token_grant_type = token_grant_type
-        else:
-            self.keycloak_openid = None 
+        if not token_manager and keycloak_url:
+            token_manager = KeycloakTokenManager(keycloak_url, keycloak_realm, client_id, client_secret_key, token_grant_type)
+        self.token_manager = token_manager
 
     def _get_token_token(self, get_token=None) -> str:
         if get_token:
             return get_token()
-        now = datetime.now()
-        if not self.token or now >= self.token_expire:    
-            self.token = self.keycloak_openid.token(grant_type=self.token_grant_type)
-            self.token_expire =  now + timedelta(seconds=int(self.token['expires_in'])-5)
-            print ("  🔑  got new token at", now, "token expires at", self.token_expire, "(", int(self.token['expires_in']), "- 5 sec)")
-        return self.token['access_token']
+        return self.token_manager.get_token()
 
     def _build_headers(self, get_token=None, tenant=None, context=None, accept='application/json', extra_headers=None) -> dict:
-        headers = {
-            'Accept': accept,
-        }
+        # the immutable part of the headers only depends on (tenant, context, accept) and is built once
+        header_key = (tenant, context, accept)
+        base_headers = self._header_cache.get(header_key)
+        if base_headers is None:
+            base_headers = {
+                'Accept': accept,
+            }
+            if tenant and not self.add_tenant_to_path:
+                base_headers['NGSILD-Tenant'] = tenant
+            if context:
+                base_headers['Content-Type'] = 'application/json'
+                base_headers['Link'] = '<'+context+'>; rel="http://www.w3.org/ns/json-ld#context"; type="application/ld+json"'
+            else:
+                base_headers['Content-Type'] = 'application/ld+json'
+            self._header_cache[header_key] = base_headers
+        headers = base_headers.copy()
         if get_token:
             headers['Authorization'] = 'Bearer '+get_token()
-        elif self.keycloak_openid:
+        elif self.token_manager:
             headers['Authorization'] = 'Bearer '+self._get_token_token()
-        if tenant and not self.add_tenant_to_path:
-            headers['NGSILD-Tenant'] = tenant
         if extra_headers:
-            headers.update(extra_headers)
-        if context:
-            headers['Content-Type'] = 'application/json'
-            headers['Link'] = '<'+context+'>; rel="http://www.w3.org/ns/json-ld#context"; type="application/ld+json"'
-        else:
-            headers['Content-Type'] = 'application/ld+json'
+            headers.update({k: v for k, v in extra_headers.items() if k not in ('Content-Type', 'Link')})
         return headers
 
+    def _query_string(self, params) -> str:
+        query_params = {}
+        for name, value in params.items():
+            if value is None or value == '' or value == []:
+                continue
+            if isinstance(value, (list, tuple)):
+                value = ','.join(value)
+            query_params[name] = value
+        if not query_params:
+            return ''
+        return '?'+urlencode(query_params, safe=',:', quote_via=quote)
+
     def _build_url(self, url:str, tenant:str) -> str:
         if url.startswith('http://') or url.startswith('https://'):
             return url
@@ -77,363 +1675,1488 @@ class ContextBrokerClient:
         else:
             complete_url += url
         return complete_url
-    
+
     def _print_json_data(self, json_data):
         if COLOR_JSON and len(json_data)<1024:
             print(highlight(json.dumps( json_data, indent=2), JsonLexer(), TerminalFormatter()))
         else:
             print(json.dumps( json_data, indent=2))
 
-    def get(self, url:str, get_token=None, tenant:str=None, context:str=None, accept:str='application/ld+json', extra_headers=None, print_response:bool=True, print_request_headers:bool=False, retry:int=0, verbose=True):
+    def metrics(self) -> dict:
+        metrics = self.instrumentation.snapshot()
+        if self.token_manager:
+            metrics['counters']['token_refreshes'] = self.token_manager.token_refreshes
+        if self.response_cache is not None:
+            cache_stats = self.response_cache.stats()
+            metrics['counters']['cache_hits'] = cache_stats['hits']
+            metrics['counters']['cache_misses'] = cache_stats['misses']
+            metrics['counters']['cache_revalidations'] = cache_stats['revalidations']
+        if self.flow_control:
+            metrics['flow_control'] = self.flow_control.snapshot()
+        return metrics
+
+    def _log_error_body(self, content):
+        if not logger.isEnabledFor(logging.WARNING):
+            return
+        try:
+            json_data = self.codec.loads(content) if content else None
+        except ValueError:
+            json_data = None
+        if json_data:
+            logger.warning('⏪ %s', json.dumps(json_data, indent=2))
+        else:
+            logger.warning('⏪ %s', content)
+
+    def _write_result(self, url, response, verbose):
+        if (response.status_code>=200 and response.status_code<300) or response.status_code == 404:
+            self._invalidate_cached(url)
+            return (True, response.status_code, response.headers, None)
+        if verbose:
+            self._log_error_body(response.content)
+        return (False, response.status_code, response.headers, response.content)
+
+    def _get_result(self, url, response, cache_key, print_response, response_mode, verbose):
+        if response.status_code == 304 and cache_key:
+            cached = self.response_cache.revalidated(cache_key)
+            if cached:
+                return self._shape_response(cached, response_mode)
+
+        if response.status_code == 200 and response_mode == 'raw':
+            if cache_key:
+                self.response_cache.put(cache_key, None, response.content, response.headers)
+            return (response.content, None, response.headers)
+
+        if response.status_code == 200:
+            json_data = self.codec.loads(response.content) if response.content else None
+            if print_response:
+                self._print_json_data(json_data)
+            if cache_key:
+                self.response_cache.put(cache_key, json_data, response.content, response.headers)
+            return self._shape_response((json_data, response.content, response.headers), response_mode)
+        if verbose:
+            self._log_error_body(response.content)
+        return (None, response.content, response.headers)
+
+    def _shape_response(self, result, response_mode):
+        json_data, content, headers = result
+        if response_mode == 'raw':
+            return (content, None, headers)
+        if json_data is None and content:
+            json_data = self.codec.loads(content)
+        if response_mode == 'json':
+            return (json_data, None, headers)
+        return (json_data, content, headers)
+
+    def _invalidate_cached(self, url:str):
+        # a write to an entity or one of its attributes makes every cached read of that entity stale
+        if self.response_cache is not None and url:
+            entity_url = url.split('?', 1)[0].split('/attrs', 1)[0]
+            self.response_cache.invalidate(entity_url)
+
+    def _batch_chunks(self, items, chunk_size, max_chunk_bytes):
+        # items are serialised once, chunks are bounded both by entity count and by request body size
+        chunk = []
+        chunk_bytes = 2
+        for item in items:
+            entity_id = item if isinstance(item, str) else item['id']
+            item_data = self.codec.dumps(item)
+            if chunk and (len(chunk) >= chunk_size or chunk_bytes+len(item_data)+1 > max_chunk_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 2
+            chunk.append((entity_id, item_data))
+            chunk_bytes += len(item_data)+1
+        if chunk:
+            yield chunk
+
+    def _batch_chunk_data(self, chunk) -> bytes:
+        return b'['+b','.join(item_data for _, item_data in chunk)+b']'
+
+    def _batch_chunk_result(self, chunk, status_code, content):
+        # returns (succeeded ids, {failed id: error}, failed part of the chunk)
+        if status_code in (200, 201, 204):
+            return ([entity_id for entity_id, _ in chunk], {}, [])
+        if status_code == 207:
+            result = self.codec.loads(content)
+            errors = {e['entityId']: e for e in result.get('errors', [])}
+            return (result.get('success', []), errors, [c for c in chunk if c[0] in errors])
+        detail = content.decode('utf-8', errors='replace')
+        errors = {entity_id: {'entityId': entity_id, 'error': {'status': status_code, 'detail': detail}} for entity_id, _ in chunk}
+        return ([], errors, chunk)
+
+    def _batch_chunk_error(self, chunk, error):
+        # a chunk that got no response fails as a whole with no status, like a transport failure in RetryPolicy
+        detail = error.__class__.__name__+': '+str(error)
+        errors = {entity_id: {'entityId': entity_id, 'error': {'status': None, 'detail': detail}} for entity_id, _ in chunk}
+        return ([], errors, chunk)
+
+    def _batch_retry_chunk(self, method, failed, errors):
+        # only the entities whose failure the retry policy deems transient are sent again, a 207 error without status is not,
+        # and every retry round spends one unit of the shared retry budget
+        policy = self.retry_policy
+        retryable = []
+        for item in failed:
+            error = errors[item[0]].get('error') or {}
+            if 'status' in error and policy.is_retryable(method, error['status']):
+                retryable.append(item)
+        if not retryable or not policy.should_retry(method, errors[retryable[0][0]]['error']['status']):
+            return []
+        return retryable
+
+    def _subscription_data(self, entity_type=None, entity_ids=None, watched_attrs=None, q=None, endpoint=None, notify_attrs=None, format='normalized', expires_at=None, throttling=None, subscription_id=None) -> dict:
+        entities = [{'id': entity_id} for entity_id in entity_ids or []]
+        if entity_type and entity_ids:
+            for entity in entities:
+                entity['type'] = entity_type
+        elif entity_type:
+            entities = [{'type': entity_type}]
+        data = {
+            'type': 'Subscription',
+            'notification': {'endpoint': {'uri': endpoint, 'accept': 'application/json'}, 'format': format},
+        }
+        if subscription_id:
+            data['id'] = subscription_id
+        if entities:
+            data['entities'] = entities
+        if watched_attrs:
+            data['watchedAttributes'] = list(watched_attrs)
+        if q:
+            data['q'] = q
+        if notify_attrs:
+            data['notification']['attributes'] = list(notify_attrs)
+        if expires_at:
+            data['expiresAt'] = _format_time(expires_at)
+        if throttling:
+            data['throttling'] = throttling
+        return data
+
+    def _subscription_id(self, headers, data):
+        if data.get('id'):
+            return data['id']
+        location = headers.get('Location')
+        return location.rstrip('/').rsplit('/', 1)[-1] if location else None
+
+    def _typed(self, json_data):
+        if not self.typed_entities or not json_data:
+            return json_data
+        if isinstance(json_data, list):
+            return [Entity.from_dict(e) for e in json_data]
+        return Entity.from_dict(json_data)
+
+    def _entities_path(self, type_name, attrs=None, query_params=None):
+        params = {'type': type_name, 'attrs': attrs}
+        if query_params:
+            params.update(query_params)
+        return 'entities'+self._query_string(params)
+
+    def _page_result(self, response, print_response=False):
+        # an error must not look like the last page, only an empty or short 200 page ends the iteration
+        if response.status_code >= 400:
+            self._log_error_body(response.content)
+            response.raise_for_status()
+        if response.status_code != 200 or not response.content:
+            return (None, response.headers)
+        json_data = self.codec.loads(response.content)
+        if print_response:
+            self._print_json_data(json_data)
+        return (json_data, response.headers)
+
+    def _entity_path(self, entity_id, attrs=None):
+        return 'entities/'+quote(entity_id, safe=':')+self._query_string({'attrs': attrs})
+
+    def _temporal_params(self, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None) -> dict:
+        params = {'lastN': last_n, 'format': format, 'attrs': attrs}
+        if query_params:
+            params.update(query_params)
+        if from_time and to_time:
+            params.update({'timerel': 'between', 'timeAt': from_time, 'endTimeAt': to_time})
+        elif from_time: 
+            params.update({'timerel': 'after', 'timeAt': from_time})
+        elif to_time:
+            params.update({'timerel': 'before', 'timeAt': to_time})
+        return params
+
+    def _temporal_entities_path(self, type_name, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None):
+        params = {'type': type_name}
+        params.update(self._temporal_params(attrs, last_n, format, from_time, to_time, query_params))
+        return 'temporal/entities'+self._query_string(params)
+
+    def _merge_temporal_entities(self, merged, window_entities):
+        for entity in window_entities:
+            merged_entity = merged.setdefault(entity['id'], {'id': entity['id'], 'type': entity.get('type')})
+            for attr_name, attr_data in entity.items():
+                if attr_name in ('id', 'type', '@context'):
+                    continue
+                instances = merged_entity.setdefault(attr_name, {})
+                for instance in attr_data if isinstance(attr_data, list) else [attr_data]:
+                    instance_key = instance.get('instanceId') or (instance.get('observedAt'), instance.get('datasetId'))
+                    instances[instance_key] = instance
+
+    def _sorted_temporal_entity(self, merged_entity):
+        entity = {'id': merged_entity['id'], 'type': merged_entity['type']}
+        for attr_name, instances in merged_entity.items():
+            if attr_name not in ('id', 'type'):
+                entity[attr_name] = sorted(instances.values(), key=lambda i: _parse_time(i['observedAt']) if i.get('observedAt') else datetime.min.replace(tzinfo=timezone.utc))
+        return entity
+
+    def _temporal_entity_path(self, entity_id, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None):
+        params = self._temporal_params(attrs, last_n, format, from_time, to_time, query_params)
+        return 'temporal/entities/'+quote(entity_id, safe=':')+self._query_string(params)
+
+    def prepare(self, url:str, tenant:str=None, context:str=None, accept:str='application/ld+json', params=None) -> 'RequestTemplate':
+        if not tenant:
+            tenant = self.tenant
+        return RequestTemplate(self, self._build_url(url, tenant), tenant, context, accept, params)
+
+    def prepare_entity(self, entity_id, context=None, sdm_model=None, attrs=None, tenant=None) -> 'RequestTemplate':
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        return self.prepare('entities/'+quote(entity_id, safe=':'), tenant, context, params={'attrs': attrs})
+
+    def prepare_temporal_entity(self, entity_id, context=None, sdm_model=None, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None, tenant=None) -> 'RequestTemplate':
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        params = self._temporal_params(attrs, last_n, format, from_time, to_time, query_params)
+        return self.prepare('temporal/entities/'+quote(entity_id, safe=':'), tenant, context, params=params)
+
+    def sdm_type_to_context(self, type_name):
+        if type_name.startswith('https://smartdatamodels.org/'):
+            model_name, short_type_name = type_name.replace('https://smartdatamodels.org/', '').split('/', 2)
+            return (short_type_name, 'https://raw.githubusercontent.com/smart-data-models/'+model_name+'/master/context.jsonld')
+        return (type_name, None)
+
+    def sdm_model_to_context(self, model_name):
+        return 'https://raw.githubusercontent.com/smart-data-models/dataModel.'+model_name+'/master/context.jsonld'
+
+    def _get_context_registry(self) -> ContextRegistry:
+        if self.context_registry is None:
+            self.context_registry = ContextRegistry()
+        return self.context_registry
+
+    def expand_term(self, term, context=None, sdm_model=None) -> str:
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        if not context:
+            return term
+        return self._get_context_registry().expand(term, context)
+
+    def compact_term(self, iri, context=None, sdm_model=None) -> str:
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        if not context:
+            return iri
+        return self._get_context_registry().compact(iri, context)
+
+class ContextBrokerClient(_ContextBrokerClientBase):
+
+    def __init__(self, base_url=None, tenant=None, add_tenant_to_path=False, keycloak_url=None, keycloak_realm=None, client_id=None, client_secret_key=None, token_grant_type="client_credentials", token_manager=None, response_cache=None, context_registry=None, codec=None, response_mode='full', typed_entities=False, retry_policy=None, instrumentation=None, flow_control=None) -> None:
+        super().__init__(base_url, tenant, add_tenant_to_path, keycloak_url, keycloak_realm, client_id, client_secret_key, token_grant_type, token_manager, response_cache, context_registry, codec, response_mode, typed_entities, retry_policy, instrumentation, flow_control)
+        self.session = requests.Session()
+
+    def _request(self, method, url, get_token=None, tenant=None, context=None, accept='application/json', extra_headers=None, data=None, retry:int=0, retry_delay=None, print_request_headers=False, verbose=True):
+        # shared by all verbs: fresh token per attempt, backoff with jitter, Retry-After and the broker circuit breaker
+        policy = self.retry_policy
+        instrumentation = self.instrumentation
+        flow_control = self.flow_control
+        attempts = retry or policy.max_attempts
+        bytes_sent = len(data) if data else 0
+        attempt = 0
+        with instrumentation.span(method, url, tenant) as span:
+            while True:
+                attempt += 1
+                policy.before_request()
+                if self.rate_limiter:
+                    self.rate_limiter.acquire()
+                headers = self._build_headers(get_token, tenant, context, accept, extra_headers)
+                if verbose and print_request_headers and attempt == 1:
+                    logger.debug('⏩ request headers: %s', headers)
+                instrumentation.before_request(method, url, tenant)
+                endpoint_class = flow_control.acquire(method, url) if flow_control else None
+                started = time.perf_counter()
+                response = None
+                try:
+                    response = self.session.request(method, url, headers=headers, data=data)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                finally:
+                    # the slot is given back before any retry delay
+                    if endpoint_class:
+                        flow_control.release(endpoint_class, time.perf_counter()-started, response.status_code if response is not None else None)
+                if response is None:
+                    instrumentation.after_response(method, url, tenant, None, time.perf_counter()-started, bytes_sent, 0, span)
+                    policy.record(True)
+                    if attempt >= attempts or not policy.should_retry(method, None):
+                        raise error
+                    delay = policy.delay(attempt, None, retry_delay)
+                    if verbose:
+                        logger.warning('🚨 %s, retrying in %.2f sec...', error.__class__.__name__, delay)
+                    instrumentation.count('retries')
+                    time.sleep(delay)
+                    continue
+                instrumentation.after_response(method, url, tenant, response.status_code, time.perf_counter()-started, bytes_sent, len(response.content), span)
+                policy.record(policy.is_failure(response.status_code))
+                if verbose:
+                    logger.debug('⏪ %s %s %s sec', response.status_code, response.reason, response.elapsed.total_seconds())
+                if attempt >= attempts or not policy.should_retry(method, response.status_code):
+                    return response
+                delay = policy.delay(attempt, response.headers.get('Retry-After'), retry_delay)
+                if verbose:
+                    logger.warning('🚨 %s, retrying in %.2f sec...', response.status_code, delay)
+                instrumentation.count('retries')
+                time.sleep(delay)
+
+    def get(self, url:str, get_token=None, tenant:str=None, context:str=None, accept:str='application/ld+json', extra_headers=None, print_response:bool=False, print_request_headers:bool=False, retry:int=0, retry_delay=None, response_mode=None, verbose=True):
+        if not tenant:
+            tenant = self.tenant
+        if not response_mode:
+            response_mode = self.response_mode
+        url = self._build_url(url, tenant)
+
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = (url, tenant, context, accept)
+            cached = self.response_cache.get(cache_key)
+            if cached:
+                if verbose:
+                    logger.debug('⏪ GET %s tenant: %s served from cache', url, tenant)
+                return self._shape_response(cached, response_mode)
+            conditional_headers = self.response_cache.conditional_headers(cache_key)
+            if conditional_headers:
+                extra_headers = {**(extra_headers or {}), **conditional_headers}
+
+        if verbose:
+            logger.debug('⏩ GET %s tenant: %s', url, tenant)
+        response = self._request('GET', url, get_token, tenant, context, accept, extra_headers, None, retry, retry_delay, print_request_headers, verbose)
+        return self._get_result(url, response, cache_key, print_response, response_mode, verbose)
+
+    def iter_get(self, url:str, get_token=None, tenant:str=None, context:str=None, accept:str='application/ld+json', extra_headers=None, chunk_size=64*1024, verbose=True):
+        # streams a JSON array response and yields its items as they are parsed, the full body is never held in memory
+        if not tenant:
+            tenant = self.tenant
+        url = self._build_url(url, tenant)
+        if verbose:
+            logger.debug('⏩ GET %s tenant: %s (streaming)', url, tenant)
+        headers = self._build_headers(get_token, tenant, context, accept, extra_headers)
+        with self.session.get(url, headers=headers, stream=True) as response:
+            if verbose:
+                logger.debug('⏪ %s %s %s sec', response.status_code, response.reason, response.elapsed.total_seconds())
+            if response.status_code != 200:
+                if verbose:
+                    logger.warning('⏪ %s', response.content)
+                return
+            parser = JsonArrayParser()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                yield from parser.feed(chunk)
+            yield from parser.feed(b'', final=True)
+
+    def post(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', data=None, extra_headers=None, print_request_headers=False, retry:int=0, retry_delay=None, verbose=True):
+        if not tenant:
+            tenant = self.tenant
+        url = self._build_url(url, tenant)
+
+        if isinstance(data, (bytes, bytearray)):
+            binary_data = data
+        else:
+            binary_data = self.codec.dumps(data)
+
+        if verbose:
+            logger.debug('⏩ POST %s tenant: %s size: %d bytes', url, tenant, len(binary_data))
+        response = self._request('POST', url, get_token, tenant, context, accept, extra_headers, binary_data, retry, retry_delay, print_request_headers, verbose)
+        return self._write_result(url, response, verbose)
+
+    def put(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', data=None, extra_headers=None, print_request_headers=False, retry:int=0, retry_delay=None, verbose=True):
         if not tenant:
             tenant = self.tenant
-        if not retry:
-            retry = 1
         url = self._build_url(url, tenant)
 
         if verbose:
-            print('⏩ GET', url, 'tenant:', tenant)
-        headers = self._build_headers(get_token, tenant, context, accept, extra_headers)
-        if verbose and print_request_headers:
-            print('⏩ request headers: ', headers)
-
-        response = self.session.get(url, headers=headers)
+            logger.debug('⏩ PUT %s tenant: %s', url, tenant)
+        response = self._request('PUT', url, get_token, tenant, context, accept, extra_headers, data, retry, retry_delay, print_request_headers, verbose)
+        return self._write_result(url, response, verbose)
+    
+    def patch(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', data=None, extra_headers=None, print_request_headers=False, retry:int=0, retry_delay=None, verbose=True):
+        if not tenant:
+            tenant = self.tenant
+        url = self._build_url(url, tenant)
 
         if verbose:
-            print('⏪', response.status_code, response.reason, response.elapsed.total_seconds())
-        #   print('⏪', response.headers)
-
-        json_data = response.json()
-        if response.status_code == 200:
-            # json_data = response.json()
-            if print_response:
-                self._print_json_data(json_data)
-            return (json_data, response.content, response.headers)
-        else:
-            if verbose:
-                # print('⏪', response.headers)
-                if json_data:
-                    self._print_json_data(json_data)
-                else:
-                    print('⏪', response.content)
-
-        return (None, response.content, response.headers)
+            logger.debug('⏩ PATCH %s tenant: %s', url, tenant)
+        response = self._request('PATCH', url, get_token, tenant, context, accept, extra_headers, data, retry, retry_delay, print_request_headers, verbose)
+        return self._write_result(url, response, verbose)
     
-    def post(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', data=None, extra_headers=None, print_request_headers=False, retry:int=0, verbose=True):
+    def delete(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', extra_headers=None, print_request_headers=False, retry:int=0, retry_delay=None, verbose=True):
         if not tenant:
             tenant = self.tenant
-        if not retry:
-            retry = 1
         url = self._build_url(url, tenant)
 
-        if isinstance(data, bytearray):
-            binary_data = data
-        else:
-            binary_data = json.dumps(data).encode(encoding='utf-8')
-
         if verbose:
-            print('⏩ POST', url, 'tenant:', tenant, "size:", len(binary_data), 'bytes')
-        headers = self._build_headers(get_token, tenant, context, accept, extra_headers)
-        if verbose and print_request_headers:
-            print('⏩ request headers: ', headers)
+            logger.debug('⏩ DELETE %s tenant: %s', url, tenant)
+        response = self._request('DELETE', url, get_token, tenant, context, accept, extra_headers, None, retry, retry_delay, print_request_headers, verbose)
+        return self._write_result(url, response, verbose)
 
-        resp_status = 0
-        retry_cnt = 0
+    def batch_create(self, entities, tenant=None, context=None, chunk_size=500, max_chunk_bytes=1024*1024, workers=4, retry:int=0, retry_delay=None, verbose=True) -> dict:
+        return self._batch_operation('create', entities, tenant, context, chunk_size, max_chunk_bytes, workers, retry, retry_delay, verbose)
 
-        while not (resp_status>=200 and resp_status<300) and retry>retry_cnt:
-            retry_cnt += 1
-            if get_token or self.keycloak_openid:
-                headers['Authorization'] = 'Bearer '+ self._get_token_token(get_token)
-            response = self.session.post(
-                url,
-                headers = headers,
-                data = binary_data
-            )
-            resp_status = response.status_code
-            if verbose:
-                print('⏪', response.status_code, response.reason, response.elapsed.total_seconds(), 'sec')
-            if (resp_status>=200 and resp_status<300) or resp_status == 404:
-                return (True, response.status_code, response.headers, None)
-            else:
-                last_resp_status = response.status_code
-                last_resp_headers = response.headers
-                last_resp_content = response.content
-                if verbose:
-                    # print('⏪', response.headers)
-                    json_data = response.json
-                    if json_data:
-                        self._print_json_data(json_data)
-                    else:
-                        print('⏪', response.content)
-                if retry>retry_cnt:
-                    delay = retry_cnt*5
-                    if verbose:
-                        print("🚨 retrying in", delay, "sec...")
-                    time.sleep(retry_cnt*5)
-        return (False, last_resp_status, last_resp_headers, last_resp_content)
+    def batch_upsert(self, entities, replace=True, tenant=None, context=None, chunk_size=500, max_chunk_bytes=1024*1024, workers=4, retry:int=0, retry_delay=None, verbose=True) -> dict:
+        operation = 'upsert' if replace else 'upsert?options=update'
+        return self._batch_operation(operation, entities, tenant, context, chunk_size, max_chunk_bytes, workers, retry, retry_delay, verbose)
 
-    def put(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', data=None, extra_headers=None, print_request_headers=False, retry:int=0, retry_delay=5, verbose=True):
-        if not tenant:
-            tenant = self.tenant
-        if not url:
-            url = self._build_url(url, tenant)
-        if not retry:
-            retry = 1
+    def batch_update(self, entities, overwrite=True, tenant=None, context=None, chunk_size=500, max_chunk_bytes=1024*1024, workers=4, retry:int=0, retry_delay=None, verbose=True) -> dict:
+        operation = 'update' if overwrite else 'update?options=noOverwrite'
+        return self._batch_operation(operation, entities, tenant, context, chunk_size, max_chunk_bytes, workers, retry, retry_delay, verbose)
 
-        print('⏩ PUT', url, 'tenant:', tenant)
-        headers = self._build_headers(get_token, tenant, context, accept, extra_headers)
-        if print_request_headers:
-            print("⏩ request headers: ", headers)
+    def batch_delete(self, entity_ids, tenant=None, chunk_size=500, max_chunk_bytes=1024*1024, workers=4, retry:int=0, retry_delay=None, verbose=True) -> dict:
+        return self._batch_operation('delete', entity_ids, tenant, None, chunk_size, max_chunk_bytes, workers, retry, retry_delay, verbose)
 
-        resp_status = 0
+    def _send_batch_chunk(self, url, chunk, tenant, context, retry, retry_delay, method, verbose):
+        success = []
+        errors = {}
         retry_cnt = 0
-        while not (resp_status>=200 and resp_status<300) and retry>retry_cnt:
+        while chunk and retry > retry_cnt:
             retry_cnt += 1
-            if get_token or self.keycloak_openid:
-                headers['Authorization'] = 'Bearer '+ self._get_token_token(get_token)
-            response = self.session.put(
-                url,
-                headers = headers,
-                data = data
-            )
-            resp_status = response.status_code
-            print('⏪', response.status_code, response.reason, response.elapsed.total_seconds(), 'sec')
-            if (resp_status>=200 and resp_status<300) or resp_status == 404:
-                return (True, response.status_code, response.headers, None)
+            retry_after = None
+            try:
+                response = self._request('POST', url, None, tenant, context, 'application/json', None, self._batch_chunk_data(chunk), 1, retry_delay, False, False)
+            except requests.RequestException as e:
+                # a reset connection or an open circuit fails this chunk only, the other chunks keep their results
+                if verbose:
+                    logger.warning('🚨 %s, %d entities', e.__class__.__name__, len(chunk))
+                chunk_success, chunk_errors, failed = self._batch_chunk_error(chunk, e)
             else:
-                last_resp_status = response.status_code
-                last_resp_headers = response.headers
-                last_resp_content = response.content
                 if verbose:
-                    # print('⏪', response.headers)
-                    json_data = response.json
-                    if json_data:
-                        self._print_json_data(json_data)
-                    else:
-                        print('⏪', response.content)
-                if retry>retry_cnt:
-                    delay = retry_cnt*5
-                    print("🚨 retrying in", delay, "sec...")
-                    time.sleep(retry_cnt*retry_delay)
-        return (False, last_resp_status, last_resp_headers, last_resp_content)
-    
-    def patch(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', data=None, extra_headers=None, print_request_headers=False, retry:int=0):
+                    logger.debug('⏪ %s %s %s sec, %d entities', response.status_code, response.reason, response.elapsed.total_seconds(), len(chunk))
+                retry_after = response.headers.get('Retry-After')
+                chunk_success, chunk_errors, failed = self._batch_chunk_result(chunk, response.status_code, response.content)
+            success.extend(chunk_success)
+            for entity_id in chunk_success:
+                errors.pop(entity_id, None)
+            errors.update(chunk_errors)
+            chunk = self._batch_retry_chunk(method, failed, errors) if retry > retry_cnt else []
+            if chunk:
+                delay = self.retry_policy.delay(retry_cnt, retry_after, retry_delay)
+                if verbose:
+                    logger.warning('🚨 retrying %d failed entities in %.2f sec...', len(chunk), delay)
+                self.instrumentation.count('retries')
+                time.sleep(delay)
+        return (success, list(errors.values()))
+
+    def _batch_operation(self, operation, items, tenant, context, chunk_size, max_chunk_bytes, workers, retry, retry_delay, verbose) -> dict:
         if not tenant:
             tenant = self.tenant
-        if not url:
-            url = self._build_url(url, tenant)
         if not retry:
             retry = 1
+        url = self._build_url('entityOperations/'+operation, tenant)
+        # upsert, update and delete can be repeated safely, the retry policy judges them like a PUT
+        method = 'POST' if operation == 'create' else 'PUT'
+        if verbose:
+            logger.debug('⏩ POST %s tenant: %s', url, tenant)
 
-        print('⏩ PATCH', url, 'tenant:', tenant)
-        headers = self._build_headers(get_token, tenant, context, accept, extra_headers)
-        if print_request_headers:
-            print("⏩ request headers: ", headers)
+        result = {'success': [], 'errors': []}
+        def collect(futures):
+            for future in futures:
+                success, errors = future.result()
+                result['success'].extend(success)
+                result['errors'].extend(errors)
 
-        resp_status = 0
-        retry_cnt = 0
-        while not (resp_status>=200 and resp_status<300) and retry>retry_cnt:
-            retry_cnt += 1
-            if get_token or self.keycloak_openid:
-                headers['Authorization'] = 'Bearer '+ self._get_token_token(get_token)
-            response = self.session.patch(
-                url,
-                headers = headers,
-                data = data
-            )
-            resp_status = response.status_code
-            print('⏪', response.status_code, response.reason, response.elapsed.total_seconds(), 'sec')
-            if (resp_status>=200 and resp_status<300) or resp_status == 404:
-                return (True, response.status_code, response.headers, None)
-            else:
-                last_resp_status = response.status_code
-                last_resp_headers = response.headers
-                last_resp_content = response.content
-                # print('⏪', response.headers)
-                json_data = response.json
-                if json_data:
-                    self._print_json_data(json_data)
-                else:
-                    print('⏪', response.content)
-                if retry>retry_cnt:
-                    delay = retry_cnt*5
-                    print("🚨 retrying in", delay, "sec...")
-                    time.sleep(retry_cnt*5)
-        return (False, last_resp_status, last_resp_headers, last_resp_content)
-    
-    def delete(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', extra_headers=None, print_request_headers=False, retry:int=0):
+        # at most 2 chunks per worker are queued so large input iterables are never materialised
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            in_flight = set()
+            for chunk in self._batch_chunks(items, chunk_size, max_chunk_bytes):
+                if len(in_flight) >= workers*2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(pool.submit(self._send_batch_chunk, url, chunk, tenant, context, retry, retry_delay, method, verbose))
+            collect(in_flight)
+        if result['success'] and self.response_cache is not None:
+            self.response_cache.invalidate()
+        if verbose:
+            logger.info('⏪ %s %d succeeded, %d failed', operation, len(result['success']), len(result['errors']))
+        return result
+
+    def temporal_writer(self, tenant=None, context=None, max_batch_samples=5000, flush_interval=1.0, max_queue_size=100000, workers=4, retry:int=0, verbose=False) -> TemporalWriter:
+        return TemporalWriter(self, tenant, context, max_batch_samples, flush_interval, max_queue_size, workers, retry, verbose)
+
+    def entity_mirror(self, types, context=None, sdm_model=None, attrs=None, query_params=None, path=None, page_size=1000, overlap=timedelta(seconds=1), full_sync_interval=timedelta(hours=1), verbose=False) -> EntityMirror:
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        return EntityMirror(self, types, context, attrs, query_params, path, page_size, overlap, full_sync_interval, verbose)
+
+    def create_subscription(self, entity_type=None, entity_ids=None, watched_attrs=None, q=None, endpoint=None, context=None, sdm_model=None, notify_attrs=None, format='normalized', expires_at=None, throttling=None, subscription_id=None, tenant=None, verbose=False):
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        data = self._subscription_data(entity_type, entity_ids, watched_attrs, q, endpoint, notify_attrs, format, expires_at, throttling, subscription_id)
+        if not context:
+            data['@context'] = NGSI_LD_CORE_CONTEXT
+        success, _, headers, _ = self.post('subscriptions', tenant=tenant, context=context, data=data, verbose=verbose)
+        return self._subscription_id(headers, data) if success else None
+
+    def renew_subscription(self, subscription_id, expires_at, tenant=None, verbose=False) -> bool:
+        data = self.codec.dumps({'expiresAt': _format_time(expires_at), '@context': NGSI_LD_CORE_CONTEXT})
+        success, status, _, _ = self.patch('subscriptions/'+quote(subscription_id, safe=':'), tenant=tenant, data=data, verbose=verbose)
+        # a 404 means the subscription is gone, renewing it did not succeed
+        return success and status != 404
+
+    def delete_subscription(self, subscription_id, tenant=None, verbose=False) -> bool:
+        success, _, _, _ = self.delete('subscriptions/'+quote(subscription_id, safe=':'), tenant=tenant, verbose=verbose)
+        return success
+
+    def get_subscriptions(self, tenant=None, context=None, print_response=False):
+        json_data, _, _ = self.get('subscriptions', tenant=tenant, context=context, print_response=print_response, response_mode='json')
+        return json_data
+
+    def subscribe(self, receiver:NotificationReceiver, entity_type=None, entity_ids=None, watched_attrs=None, q=None, context=None, sdm_model=None, notify_attrs=None, format='normalized', ttl=timedelta(hours=1), throttling=None, tenant=None, verbose=False):
+        # subscribes the receiver and keeps the subscription alive until the receiver is closed
         if not tenant:
             tenant = self.tenant
-        if not retry:
-            retry = 1
-        url = self._build_url(url, tenant)
+        subscription_id = self.create_subscription(entity_type, entity_ids, watched_attrs, q, receiver.url, context, sdm_model, notify_attrs, format, datetime.now(timezone.utc)+ttl, throttling, tenant=tenant, verbose=verbose)
+        if subscription_id:
+            receiver.track(self, subscription_id, tenant, ttl)
+        return subscription_id
 
+    def set_pool_size(self, pool_size:int):
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-        print('⏩ DELETE', url, 'tenant:', tenant)
-        headers = self._build_headers(get_token, tenant, context, accept, extra_headers)
-        if print_request_headers:
-            print("⏩ request headers: ", headers)
+    def ql_download_temporal_entities(scorpio, ql, entities=None, types=None, exclude_types=('AirQualityObserved',), batch_size=10000, scorpio_workers=4, ql_workers=8, prefetch_pages=2, checkpoint_file='ql_download_checkpoint.jsonl', sink=None, export_dir='ql_export'):
+        scorpio.set_pool_size(scorpio_workers)
+        ql.set_pool_size(ql_workers)
+        checkpoint = _DownloadCheckpoint(checkpoint_file)
+        # pages are streamed into the sink, an NdjsonSink is created (and closed) here when none is given
+        owned_sink = sink is None
+        if owned_sink:
+            sink = NdjsonSink(export_dir)
 
-        resp_status = 0
-        retry_cnt = 0
-        while not ((resp_status>=200 and resp_status<300) or resp_status == 404) and retry>retry_cnt:
-            retry_cnt += 1
-            if get_token or self.keycloak_openid:
-                headers['Authorization'] = 'Bearer '+ self._get_token_token(get_token)
-            response = self.session.delete(
-                url,
-                headers = headers,
-            )
-            resp_status = response.status_code
-            print('⏪', response.status_code, response.reason, response.elapsed.total_seconds(), 'sec')
-            if (resp_status>=200 and resp_status<300) or resp_status == 404:
-                return (True, response.status_code, response.headers, None)
-            else:
-                last_resp_status = response.status_code
-                last_resp_headers = response.headers
-                last_resp_content = response.content
-                # print('⏪', response.headers)
-                json_data = response.json
-                if json_data:
-                    self._print_json_data(json_data)
+        def fetch_json(client, path):
+            # only a 200 is data and a 404 is the end of it (or a missing entity), any other status raises
+            # so that the checkpoint never records progress that was not made
+            response = client._request('GET', client._build_url(path, client.tenant), None, client.tenant, None, 'application/ld+json', verbose=False)
+            if response.status_code == 404:
+                return None
+            json_data, _ = client._page_result(response)
+            return json_data
+
+        with sink if owned_sink else contextlib.nullcontext(), ThreadPoolExecutor(max_workers=scorpio_workers) as scorpio_pool, ThreadPoolExecutor(max_workers=ql_workers) as ql_pool:
+            if not entities:
+                if not types:
+                    types_data = fetch_json(scorpio, 'types')
+                    tenant_types = types_data['typeList'] if types_data else []
                 else:
-                    print('⏪', response.content)
-                if retry>retry_cnt:
-                    delay = retry_cnt*5
-                    print("🚨 retrying in", delay, "sec...")
-                    time.sleep(retry_cnt*5)
-        return (False, last_resp_status, last_resp_headers, last_resp_content)
-
-    def ql_download_temporal_entities(scorpio, ql, entities=None, types=None):
-
-        if not entities:
-            if not types:
-                types_data, _, _ = scorpio.get('types', print_response=True)
-                if types_data:
-                    tenant_types = types_data['typeList']
-            else:
-                tenant_types = types
-
-            entities = []
-
-            for entity_type in tenant_types:
-                if entity_type not in ['AirQualityObserved']:
-                    entities_data, data, _ = scorpio.get('entities?type='+entity_type, print_response=True)
-                    with open("type_"+entity_type+'.json', "wb") as binary_file:
-                        binary_file.write(data)
-                    for e in entities_data:
-                        entities.append(e['id'])
-                        
-
-            for entity_id in entities:
-                entity_data, _, response_headers = scorpio.get('entities/'+entity_id, print_response=True)
-
-                if 'id' in entity_data and entity_data['id'] == entity_id:
-                    link = response_headers.get('Link')
-                    entity_template = entity_data
-                    entity_type = entity_template['type']
-
-                    ql_fetch_end = False
-                    batch_size = 10000
-                    batch_offset = 0
-                    record_count = 0
-                    while not ql_fetch_end:
-                        temporal_data, data, response_headers = ql.get('entities/'+entity_id+"?last_n="+str(batch_size)+"&offset="+str(batch_offset), print_response=False)
+                    tenant_types = types
+
+                def fetch_type(entity_type):
+                    # a resumed run reuses the listing it already exported instead of writing the entities again
+                    entity_ids = checkpoint.type_entities(entity_type)
+                    if entity_ids is not None:
+                        return entity_ids
+                    entities_data = fetch_json(scorpio, 'entities?type='+entity_type)
+                    entity_ids = [e['id'] for e in entities_data or []]
+                    sink.write_entities(entity_type, entities_data, on_durable=lambda: checkpoint.set_type_entities(entity_type, entity_ids))
+                    return entity_ids
+
+                entities = []
+                for type_entities in scorpio_pool.map(fetch_type, [t for t in tenant_types if t not in exclude_types]):
+                    entities.extend(type_entities)
+                # the listing is made durable, and recorded, before the downloads start
+                sink.flush()
+
+            def download_entity(entity_id):
+                entity_data = fetch_json(scorpio, 'entities/'+entity_id)
+                if not entity_data or entity_data.get('id') != entity_id:
+                    return 0
+
+                def fetch_page(batch_offset):
+                    return fetch_json(ql, 'entities/'+entity_id+"?last_n="+str(batch_size)+"&offset="+str(batch_offset))
+
+                # keep up to prefetch_pages requests in flight while the current page is written to the sink
+                next_offset = checkpoint.offset(entity_id)
+                pending = deque()
+                for _ in range(max(1, prefetch_pages)):
+                    pending.append((next_offset, ql_pool.submit(fetch_page, next_offset)))
+                    next_offset += batch_size
+
+                record_count = 0
+                entity_type = None
+                try:
+                    while pending:
+                        batch_offset, future = pending.popleft()
+                        temporal_data = future.result()
                         if not temporal_data:
                             break
                         count = len(temporal_data['index'])
-                        with open("ql_data_"+entity_id.replace(':', '_')+"-"+str(batch_offset)+'-'+str(batch_offset+count)+'.json', "wb") as binary_file:
-                            binary_file.write(data)
+                        if count >= batch_size:
+                            pending.append((next_offset, ql_pool.submit(fetch_page, next_offset)))
+                            next_offset += batch_size
+                        # the checkpoint only moves past a page once the sink reports its rows durable,
+                        # which is on a part rotation, a periodic flush or the final close
+                        if count:
+                            entity_type = temporal_data.get('entityType')
+                            sink.write_temporal(temporal_data, on_durable=lambda offset=batch_offset+batch_size: checkpoint.set_offset(entity_id, offset))
                         record_count += count
-                        batch_offset += batch_size
-                        print(count, record_count)
-                        if count<batch_size:
-                            ql_fetch_end = True
-                    continue
+                        logger.info('⏬ %s %d records, %d total', entity_id, count, record_count)
+                        if count < batch_size:
+                            break
+                finally:
+                    for _, future in pending:
+                        future.cancel()
+                sink.when_durable(lambda: checkpoint.set_completed(entity_id), entity_type)
+                return record_count
+
+            pending_entities = [e for e in entities if not checkpoint.is_completed(e)]
+            logger.info('⏬ %d of %d entities left to download', len(pending_entities), len(entities))
+            record_count = sum(scorpio_pool.map(download_entity, pending_entities))
+            if not owned_sink:
+                sink.flush()
+        # a finished export must not turn the next one into a no-op
+        checkpoint.remove()
+        return record_count
 
     def get_types(self, context=None, print_response=False):
-        json_data, _, _ = self.get('types', context=context, print_response=print_response)
+        json_data, _, _ = self.get('types', context=context, print_response=print_response, response_mode='json')
         return json_data
 
     def get_entities_by_type(self, type_name, context=None, sdm_model=None, attrs=None, print_response=False):
-        request_path = 'entities?type='+type_name
-        if attrs:
-            if isinstance(attrs, str):
-                request_path += '&attrs='+attrs
-            elif isinstance(attrs, list):
-                request_path += '&attrs='+','.join(attrs)
+        request_path = self._entities_path(type_name, attrs)
         if not context and sdm_model:
             context = self.sdm_model_to_context(sdm_model)
-        json_data, _, _ = self.get(request_path, context=context, print_response=print_response)
-        return json_data
+        json_data, _, _ = self.get(request_path, context=context, print_response=print_response, response_mode='json')
+        return self._typed(json_data)
+
+    def iter_entities(self, type_name, context=None, sdm_model=None, attrs=None, query_params=None, page_size=1000, print_response=False):
+        request_path = self._entities_path(type_name, attrs, query_params)
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        for entity in self._iter_pages(request_path, context=context, page_size=page_size, print_response=print_response):
+            yield Entity.from_dict(entity) if self.typed_entities else entity
+
+    def _iter_pages(self, request_path, context=None, page_size=1000, print_response=False):
+        # follows limit/offset pages and yields one entity at a time, only the current page is kept in memory
+        separator = '&' if '?' in request_path else '?'
+        offset = 0
+        total_count = None
+        while True:
+            page_path = request_path+separator+'limit='+str(page_size)+'&offset='+str(offset)
+            if total_count is None:
+                page_path += '&count=true'
+            response = self._request('GET', self._build_url(page_path, self.tenant), None, self.tenant, context, 'application/ld+json', verbose=False)
+            json_data, response_headers = self._page_result(response, print_response)
+            if not json_data:
+                return
+            if total_count is None:
+                results_count = response_headers.get('NGSILD-Results-Count')
+                total_count = int(results_count) if results_count else -1
+            count = len(json_data)
+            yield from json_data
+            offset += count
+            if count < page_size or (total_count >= 0 and offset >= total_count):
+                return
 
     def get_entity(self, entity_id, context=None, sdm_model=None, attrs=None, print_response=False):
-        request_path = 'entities/'+entity_id
-        if attrs:
-            if isinstance(attrs, str):
-                request_path += '?attrs='+attrs
-            elif isinstance(attrs, list):
-                request_path += '?attrs='+','.join(attrs)
-        
+        request_path = self._entity_path(entity_id, attrs)
         if not context and sdm_model:
             context = self.sdm_model_to_context(sdm_model)
-        json_data, _, _ = self.get(request_path, context=context, print_response=print_response)
-        return json_data
+        json_data, _, _ = self.get(request_path, context=context, print_response=print_response, response_mode='json')
+        return self._typed(json_data)
 
     def get_temporal_entities_by_type(self, type_name, context=None, sdm_model=None, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None, print_response=False):
-        request_path = 'temporal/entities?type='+type_name+'&lastN='+str(last_n)
-        if format:
-            request_path += '&format='+format
-        if attrs:
-            if isinstance(attrs, str):
-                request_path += '&attrs='+attrs
-            elif isinstance(attrs, list):
-                request_path += '&attrs='+','.join(attrs)
-        if query_params:
-            for qpk, qpv in query_params.items():
-                request_path += '&'+qpk+'='+qpv
-        if from_time and to_time:
-            request_path += '&timerel=between'+'&timeAt='+from_time+'&endTimeAt='+to_time
-        elif from_time: 
-            request_path += '&timerel=after'+'&timeAt='+from_time
-        elif to_time:
-            request_path += '&timerel=before'+'&timeAt='+to_time
+        request_path = self._temporal_entities_path(type_name, attrs, last_n, format, from_time, to_time, query_params)
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        json_data, _, _ = self.get(request_path, context=context, print_response=print_response, response_mode='json')
+        return json_data
+
+    def iter_temporal_entities(self, type_name, context=None, sdm_model=None, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None, page_size=100, print_response=False):
+        request_path = self._temporal_entities_path(type_name, attrs, last_n, format, from_time, to_time, query_params)
         if not context and sdm_model:
             context = self.sdm_model_to_context(sdm_model)
+        yield from self._iter_pages(request_path, context=context, page_size=page_size, print_response=print_response)
+
+    def get_temporal_entities_sharded(self, type_name, from_time, to_time, context=None, sdm_model=None, attrs=None, last_n=1000, format='concise', query_params=None, window=timedelta(hours=1), min_window=timedelta(seconds=1), workers=4, page_size=100, verbose=False):
+        if format not in ('concise', 'normalized'):
+            raise ValueError('sharded temporal queries support the concise and normalized formats only')
         if not context and sdm_model:
             context = self.sdm_model_to_context(sdm_model)
-        json_data, _, _ = self.get(request_path, context=context, print_response=print_response)
-        return json_data
+        from_time = _parse_time(from_time)
+        to_time = _parse_time(to_time)
+
+        def fetch_window(window_start, window_end):
+            return list(self.iter_temporal_entities(type_name, context, None, attrs, last_n, format, _format_time(window_start), _format_time(window_end), query_params, page_size))
+
+        def is_full(window_entities):
+            # lastN keeps only the newest instances, a full attribute means older instances were cut off
+            for entity in window_entities:
+                for attr_name, attr_data in entity.items():
+                    if isinstance(attr_data, list) and len(attr_data) >= last_n:
+                        return True
+            return False
+
+        merged = {}
+        windows = []
+        window_start = from_time
+        while window_start < to_time:
+            windows.append((window_start, min(window_start+window, to_time)))
+            window_start += window
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            in_flight = {pool.submit(fetch_window, *w): w for w in windows}
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window_start, window_end = in_flight.pop(future)
+                    window_entities = future.result()
+                    if is_full(window_entities) and window_end-window_start > min_window:
+                        middle = window_start+(window_end-window_start)/2
+                        if verbose:
+                            logger.debug('🔪 window %s - %s is full, splitting', window_start, window_end)
+                        in_flight[pool.submit(fetch_window, window_start, middle)] = (window_start, middle)
+                        in_flight[pool.submit(fetch_window, middle, window_end)] = (middle, window_end)
+                        continue
+                    if is_full(window_entities):
+                        # lastN still cuts this window at min_window, its oldest instances are missing from the result
+                        logger.warning('🚨 window %s - %s is still full at min_window, older instances were dropped, lower min_window or raise last_n', window_start, window_end)
+                    if verbose:
+                        logger.debug('⏪ window %s - %s %d entities', window_start, window_end, len(window_entities))
+                    self._merge_temporal_entities(merged, window_entities)
+
+        return [self._sorted_temporal_entity(entity) for entity in merged.values()]
 
     def get_temporal_entity(self, entity_id, context=None, sdm_model=None, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None, print_response=False):
-        request_path = 'temporal/entities/'+entity_id+'?lastN='+str(last_n)
-        if format:
-            request_path += '&format='+format
-        if attrs:
-            if isinstance(attrs, str):
-                request_path += '&attrs='+attrs
-            elif isinstance(attrs, list):
-                request_path += '&attrs='+','.join(attrs)
-        if query_params:
-            for qpk, qpv in query_params.items():
-                request_path += '&'+qpk+'='+qpv
-        if from_time and to_time:
-            request_path += '&timerel=between'+'&timeAt='+from_time+'&endTimeAt='+to_time
-        elif from_time: 
-            request_path += '&timerel=after'+'&timeAt='+from_time
-        elif to_time:
-            request_path += '&timerel=before'+'&timeAt='+to_time
+        request_path = self._temporal_entity_path(entity_id, attrs, last_n, format, from_time, to_time, query_params)
         if not context and sdm_model:
             context = self.sdm_model_to_context(sdm_model)
-        json_data, _, _ = self.get(request_path, context=context, print_response=print_response)
+        json_data, _, _ = self.get(request_path, context=context, print_response=print_response, response_mode='json')
         return json_data
 
-    def sdm_type_to_context(self, type_name):
-        if type_name.startswith('https://smartdatamodels.org/'):
-            model_name, short_type_name = type_name.replace('https://smartdatamodels.org/', '').split('/', 2)
-            return (short_type_name, 'https://raw.githubusercontent.com/smart-data-models/'+model_name+'/master/context.jsonld')
-        return (type_name, None)
-    
-    def sdm_model_to_context(self, model_name):
-        return 'https://raw.githubusercontent.com/smart-data-models/dataModel.'+model_name+'/master/context.jsonld'
+class AsyncContextBrokerClient(_ContextBrokerClientBase):
+
+    def __init__(self, base_url=None, tenant=None, add_tenant_to_path=False, keycloak_url=None, keycloak_realm=None, client_id=None, client_secret_key=None, token_grant_type="client_credentials", token_manager=None, response_cache=None, context_registry=None, codec=None, response_mode='full', typed_entities=False, retry_policy=None, instrumentation=None, max_connections=100, max_keepalive_connections=20, timeout=30.0, verify=True, flow_control=None) -> None:
+        super().__init__(base_url, tenant, add_tenant_to_path, keycloak_url, keycloak_realm, client_id, client_secret_key, token_grant_type, token_manager, response_cache, context_registry, codec, response_mode, typed_entities, retry_policy, instrumentation, flow_control)
+        self.session = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+            timeout=timeout,
+            verify=verify,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.session.aclose()
+
+    async def _async_build_headers(self, get_token=None, tenant=None, context=None, accept='application/json', extra_headers=None) -> dict:
+        # the keycloak round trip is blocking, so an expired token is refreshed in a worker thread
+        if not get_token and self.token_manager:
+            await self.token_manager.async_get_token()
+        return self._build_headers(get_token, tenant, context, accept, extra_headers)
+
+    async def _request(self, method, url, get_token=None, tenant=None, context=None, accept='application/json', extra_headers=None, data=None, retry:int=0, retry_delay=None, print_request_headers=False, verbose=True, timeout=None):
+        # same policy as the sync client, but waiting for a retry only suspends this task
+        policy = self.retry_policy
+        instrumentation = self.instrumentation
+        flow_control = self.flow_control
+        attempts = retry or policy.max_attempts
+        bytes_sent = len(data) if data else 0
+        request_args = {'timeout': timeout} if timeout else {}
+        if data is not None:
+            request_args['content'] = data
+        attempt = 0
+        with instrumentation.span(method, url, tenant) as span:
+            while True:
+                attempt += 1
+                policy.before_request()
+                if self.rate_limiter:
+                    await self.rate_limiter.async_acquire()
+                headers = await self._async_build_headers(get_token, tenant, context, accept, extra_headers)
+                if verbose and print_request_headers and attempt == 1:
+                    logger.debug('⏩ request headers: %s', headers)
+                instrumentation.before_request(method, url, tenant)
+                endpoint_class = await flow_control.async_acquire(method, url) if flow_control else None
+                started = time.perf_counter()
+                response = None
+                try:
+                    response = await self.session.request(method, url, headers=headers, **request_args)
+                except httpx.TransportError as e:
+                    error = e
+                finally:
+                    if endpoint_class:
+                        flow_control.release(endpoint_class, time.perf_counter()-started, response.status_code if response is not None else None)
+                if response is None:
+                    instrumentation.after_response(method, url, tenant, None, time.perf_counter()-started, bytes_sent, 0, span)
+                    policy.record(True)
+                    if attempt >= attempts or not policy.should_retry(method, None):
+                        raise error
+                    delay = policy.delay(attempt, None, retry_delay)
+                    if verbose:
+                        logger.warning('🚨 %s, retrying in %.2f sec...', error.__class__.__name__, delay)
+                    instrumentation.count('retries')
+                    await asyncio.sleep(delay)
+                    continue
+                instrumentation.after_response(method, url, tenant, response.status_code, time.perf_counter()-started, bytes_sent, len(response.content), span)
+                policy.record(policy.is_failure(response.status_code))
+                if verbose:
+                    logger.debug('⏪ %s %s %s sec', response.status_code, response.reason_phrase, response.elapsed.total_seconds())
+                if attempt >= attempts or not policy.should_retry(method, response.status_code):
+                    return response
+                delay = policy.delay(attempt, response.headers.get('Retry-After'), retry_delay)
+                if verbose:
+                    logger.warning('🚨 %s, retrying in %.2f sec...', response.status_code, delay)
+                instrumentation.count('retries')
+                await asyncio.sleep(delay)
+
+    async def get(self, url:str, get_token=None, tenant:str=None, context:str=None, accept:str='application/ld+json', extra_headers=None, print_response:bool=False, print_request_headers:bool=False, retry:int=0, retry_delay=None, timeout=None, response_mode=None, verbose=True):
+        if not tenant:
+            tenant = self.tenant
+        if not response_mode:
+            response_mode = self.response_mode
+        url = self._build_url(url, tenant)
+
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = (url, tenant, context, accept)
+            cached = self.response_cache.get(cache_key)
+            if cached:
+                if verbose:
+                    logger.debug('⏪ GET %s tenant: %s served from cache', url, tenant)
+                return self._shape_response(cached, response_mode)
+            conditional_headers = self.response_cache.conditional_headers(cache_key)
+            if conditional_headers:
+                extra_headers = {**(extra_headers or {}), **conditional_headers}
+
+        if verbose:
+            logger.debug('⏩ GET %s tenant: %s', url, tenant)
+        response = await self._request('GET', url, get_token, tenant, context, accept, extra_headers, None, retry, retry_delay, print_request_headers, verbose, timeout)
+        return self._get_result(url, response, cache_key, print_response, response_mode, verbose)
+
+    async def iter_get(self, url:str, get_token=None, tenant:str=None, context:str=None, accept:str='application/ld+json', extra_headers=None, chunk_size=64*1024, verbose=True):
+        if not tenant:
+            tenant = self.tenant
+        url = self._build_url(url, tenant)
+        if verbose:
+            logger.debug('⏩ GET %s tenant: %s (streaming)', url, tenant)
+        headers = await self._async_build_headers(get_token, tenant, context, accept, extra_headers)
+        async with self.session.stream('GET', url, headers=headers) as response:
+            if verbose:
+                logger.debug('⏪ %s %s', response.status_code, response.reason_phrase)
+            if response.status_code != 200:
+                if verbose:
+                    logger.warning('⏪ %s', await response.aread())
+                return
+            parser = JsonArrayParser()
+            async for chunk in response.aiter_bytes(chunk_size):
+                for item in parser.feed(chunk):
+                    yield item
+            for item in parser.feed(b'', final=True):
+                yield item
+
+    async def post(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', data=None, extra_headers=None, print_request_headers=False, retry:int=0, retry_delay=None, timeout=None, verbose=True):
+        if not tenant:
+            tenant = self.tenant
+        url = self._build_url(url, tenant)
+        if not isinstance(data, (bytes, bytearray)):
+            data = self.codec.dumps(data)
+        if verbose:
+            logger.debug('⏩ POST %s tenant: %s size: %d bytes', url, tenant, len(data))
+        response = await self._request('POST', url, get_token, tenant, context, accept, extra_headers, data, retry, retry_delay, print_request_headers, verbose, timeout)
+        return self._write_result(url, response, verbose)
+
+    async def put(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', data=None, extra_headers=None, print_request_headers=False, retry:int=0, retry_delay=None, timeout=None, verbose=True):
+        if not tenant:
+            tenant = self.tenant
+        url = self._build_url(url, tenant)
+        if verbose:
+            logger.debug('⏩ PUT %s tenant: %s', url, tenant)
+        response = await self._request('PUT', url, get_token, tenant, context, accept, extra_headers, data, retry, retry_delay, print_request_headers, verbose, timeout)
+        return self._write_result(url, response, verbose)
+
+    async def patch(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', data=None, extra_headers=None, print_request_headers=False, retry:int=0, retry_delay=None, timeout=None, verbose=True):
+        if not tenant:
+            tenant = self.tenant
+        url = self._build_url(url, tenant)
+        if verbose:
+            logger.debug('⏩ PATCH %s tenant: %s', url, tenant)
+        response = await self._request('PATCH', url, get_token, tenant, context, accept, extra_headers, data, retry, retry_delay, print_request_headers, verbose, timeout)
+        return self._write_result(url, response, verbose)
+
+    async def delete(self, url=None, get_token=None, tenant=None, context=None, accept='application/json', extra_headers=None, print_request_headers=False, retry:int=0, retry_delay=None, timeout=None, verbose=True):
+        if not tenant:
+            tenant = self.tenant
+        url = self._build_url(url, tenant)
+        if verbose:
+            logger.debug('⏩ DELETE %s tenant: %s', url, tenant)
+        response = await self._request('DELETE', url, get_token, tenant, context, accept, extra_headers, None, retry, retry_delay, print_request_headers, verbose, timeout)
+        return self._write_result(url, response, verbose)
+
+    async def batch_create(self, entities, tenant=None, context=None, chunk_size=500, max_chunk_bytes=1024*1024, workers=4, retry:int=0, retry_delay=None, verbose=True) -> dict:
+        return await self._batch_operation('create', entities, tenant, context, chunk_size, max_chunk_bytes, workers, retry, retry_delay, verbose)
+
+    async def batch_upsert(self, entities, replace=True, tenant=None, context=None, chunk_size=500, max_chunk_bytes=1024*1024, workers=4, retry:int=0, retry_delay=None, verbose=True) -> dict:
+        operation = 'upsert' if replace else 'upsert?options=update'
+        return await self._batch_operation(operation, entities, tenant, context, chunk_size, max_chunk_bytes, workers, retry, retry_delay, verbose)
+
+    async def batch_update(self, entities, overwrite=True, tenant=None, context=None, chunk_size=500, max_chunk_bytes=1024*1024, workers=4, retry:int=0, retry_delay=None, verbose=True) -> dict:
+        operation = 'update' if overwrite else 'update?options=noOverwrite'
+        return await self._batch_operation(operation, entities, tenant, context, chunk_size, max_chunk_bytes, workers, retry, retry_delay, verbose)
+
+    async def batch_delete(self, entity_ids, tenant=None, chunk_size=500, max_chunk_bytes=1024*1024, workers=4, retry:int=0, retry_delay=None, verbose=True) -> dict:
+        return await self._batch_operation('delete', entity_ids, tenant, None, chunk_size, max_chunk_bytes, workers, retry, retry_delay, verbose)
+
+    async def _send_batch_chunk(self, url, chunk, tenant, context, retry, retry_delay, method, verbose):
+        success = []
+        errors = {}
+        retry_cnt = 0
+        while chunk and retry > retry_cnt:
+            retry_cnt += 1
+            retry_after = None
+            try:
+                response = await self._request('POST', url, None, tenant, context, 'application/json', None, self._batch_chunk_data(chunk), 1, retry_delay, False, False)
+            except (httpx.TransportError, CircuitOpenError) as e:
+                # a reset connection or an open circuit fails this chunk only, the other chunks keep their results
+                if verbose:
+                    logger.warning('🚨 %s, %d entities', e.__class__.__name__, len(chunk))
+                chunk_success, chunk_errors, failed = self._batch_chunk_error(chunk, e)
+            else:
+                if verbose:
+                    logger.debug('⏪ %s %s %s sec, %d entities', response.status_code, response.reason_phrase, response.elapsed.total_seconds(), len(chunk))
+                retry_after = response.headers.get('Retry-After')
+                chunk_success, chunk_errors, failed = self._batch_chunk_result(chunk, response.status_code, response.content)
+            success.extend(chunk_success)
+            for entity_id in chunk_success:
+                errors.pop(entity_id, None)
+            errors.update(chunk_errors)
+            chunk = self._batch_retry_chunk(method, failed, errors) if retry > retry_cnt else []
+            if chunk:
+                delay = self.retry_policy.delay(retry_cnt, retry_after, retry_delay)
+                if verbose:
+                    logger.warning('🚨 retrying %d failed entities in %.2f sec...', len(chunk), delay)
+                self.instrumentation.count('retries')
+                await asyncio.sleep(delay)
+        return (success, list(errors.values()))
+
+    async def _batch_operation(self, operation, items, tenant, context, chunk_size, max_chunk_bytes, workers, retry, retry_delay, verbose) -> dict:
+        if not tenant:
+            tenant = self.tenant
+        if not retry:
+            retry = 1
+        url = self._build_url('entityOperations/'+operation, tenant)
+        # upsert, update and delete can be repeated safely, the retry policy judges them like a PUT
+        method = 'POST' if operation == 'create' else 'PUT'
+        if verbose:
+            logger.debug('⏩ POST %s tenant: %s', url, tenant)
+
+        result = {'success': [], 'errors': []}
+        def collect(tasks):
+            for task in tasks:
+                success, errors = task.result()
+                result['success'].extend(success)
+                result['errors'].extend(errors)
+
+        in_flight = set()
+        try:
+            for chunk in self._batch_chunks(items, chunk_size, max_chunk_bytes):
+                if len(in_flight) >= workers:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(asyncio.create_task(self._send_batch_chunk(url, chunk, tenant, context, retry, retry_delay, method, verbose)))
+            if in_flight:
+                done, in_flight = await asyncio.wait(in_flight)
+                collect(done)
+        finally:
+            # nothing is left running unawaited when a chunk raises or the caller is cancelled
+            for task in in_flight:
+                task.cancel()
+        if result['success'] and self.response_cache is not None:
+            self.response_cache.invalidate()
+        if verbose:
+            logger.info('⏪ %s %d succeeded, %d failed', operation, len(result['success']), len(result['errors']))
+        return result
+
+    async def create_subscription(self, entity_type=None, entity_ids=None, watched_attrs=None, q=None, endpoint=None, context=None, sdm_model=None, notify_attrs=None, format='normalized', expires_at=None, throttling=None, subscription_id=None, tenant=None, verbose=False):
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        data = self._subscription_data(entity_type, entity_ids, watched_attrs, q, endpoint, notify_attrs, format, expires_at, throttling, subscription_id)
+        if not context:
+            data['@context'] = NGSI_LD_CORE_CONTEXT
+        success, _, headers, _ = await self.post('subscriptions', tenant=tenant, context=context, data=data, verbose=verbose)
+        return self._subscription_id(headers, data) if success else None
+
+    async def renew_subscription(self, subscription_id, expires_at, tenant=None, verbose=False) -> bool:
+        data = self.codec.dumps({'expiresAt': _format_time(expires_at), '@context': NGSI_LD_CORE_CONTEXT})
+        success, status, _, _ = await self.patch('subscriptions/'+quote(subscription_id, safe=':'), tenant=tenant, data=data, verbose=verbose)
+        return success and status != 404
+
+    async def delete_subscription(self, subscription_id, tenant=None, verbose=False) -> bool:
+        success, _, _, _ = await self.delete('subscriptions/'+quote(subscription_id, safe=':'), tenant=tenant, verbose=verbose)
+        return success
+
+    async def get_subscriptions(self, tenant=None, context=None, print_response=False):
+        json_data, _, _ = await self.get('subscriptions', tenant=tenant, context=context, print_response=print_response, response_mode='json')
+        return json_data
+
+    async def get_types(self, context=None, print_response=False):
+        json_data, _, _ = await self.get('types', context=context, print_response=print_response, response_mode='json')
+        return json_data
+
+    async def get_entities_by_type(self, type_name, context=None, sdm_model=None, attrs=None, print_response=False):
+        request_path = self._entities_path(type_name, attrs)
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        json_data, _, _ = await self.get(request_path, context=context, print_response=print_response, response_mode='json')
+        return self._typed(json_data)
+
+    async def iter_entities(self, type_name, context=None, sdm_model=None, attrs=None, query_params=None, page_size=1000, print_response=False):
+        request_path = self._entities_path(type_name, attrs, query_params)
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        async for entity in self._iter_pages(request_path, context=context, page_size=page_size, print_response=print_response):
+            yield Entity.from_dict(entity) if self.typed_entities else entity
+
+    async def _iter_pages(self, request_path, context=None, page_size=1000, print_response=False):
+        separator = '&' if '?' in request_path else '?'
+        offset = 0
+        total_count = None
+        while True:
+            page_path = request_path+separator+'limit='+str(page_size)+'&offset='+str(offset)
+            if total_count is None:
+                page_path += '&count=true'
+            response = await self._request('GET', self._build_url(page_path, self.tenant), None, self.tenant, context, 'application/ld+json', verbose=False)
+            json_data, response_headers = self._page_result(response, print_response)
+            if not json_data:
+                return
+            if total_count is None:
+                results_count = response_headers.get('NGSILD-Results-Count')
+                total_count = int(results_count) if results_count else -1
+            count = len(json_data)
+            for entity in json_data:
+                yield entity
+            offset += count
+            if count < page_size or (total_count >= 0 and offset >= total_count):
+                return
+
+    async def get_entity(self, entity_id, context=None, sdm_model=None, attrs=None, print_response=False):
+        request_path = self._entity_path(entity_id, attrs)
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        json_data, _, _ = await self.get(request_path, context=context, print_response=print_response, response_mode='json')
+        return self._typed(json_data)
+
+    async def get_temporal_entities_by_type(self, type_name, context=None, sdm_model=None, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None, print_response=False):
+        request_path = self._temporal_entities_path(type_name, attrs, last_n, format, from_time, to_time, query_params)
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        json_data, _, _ = await self.get(request_path, context=context, print_response=print_response, response_mode='json')
+        return json_data
+
+    async def iter_temporal_entities(self, type_name, context=None, sdm_model=None, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None, page_size=100, print_response=False):
+        request_path = self._temporal_entities_path(type_name, attrs, last_n, format, from_time, to_time, query_params)
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        async for entity in self._iter_pages(request_path, context=context, page_size=page_size, print_response=print_response):
+            yield entity
+
+    async def get_temporal_entity(self, entity_id, context=None, sdm_model=None, attrs=None, last_n=1000, format='concise', from_time=None, to_time=None, query_params=None, print_response=False):
+        request_path = self._temporal_entity_path(entity_id, attrs, last_n, format, from_time, to_time, query_params)
+        if not context and sdm_model:
+            context = self.sdm_model_to_context(sdm_model)
+        json_data, _, _ = await self.get(request_path, context=context, print_response=print_response, response_mode='json')
+        return json_data
+
+
+TEMPORAL_AGGREGATION_METHODS = ('totalCount', 'distinctCount', 'sum', 'avg', 'min', 'max', 'stddev', 'sumsq')
+
+def _temporal_series(entity):
+    # yields (attribute, timestamps, values) for the normalized, concise, temporalValues and aggregated formats
+    for attr_name, attr_data in entity.items():
+        if attr_name in ('id', 'type', '@context', 'createdAt', 'modifiedAt', 'scope'):
+            continue
+        if isinstance(attr_data, dict):
+            if 'values' in attr_data:
+                yield (attr_name, [v[1] for v in attr_data['values']], [v[0] for v in attr_data['values']])
+                continue
+            aggregated = False
+            for method in TEMPORAL_AGGREGATION_METHODS:
+                if method in attr_data:
+                    aggregated = True
+                    yield (attr_name+'.'+method, [v[1] for v in attr_data[method]], [v[0] for v in attr_data[method]])
+            if aggregated:
+                continue
+            attr_data = [attr_data]
+        if isinstance(attr_data, list) and attr_data and isinstance(attr_data[0], dict):
+            yield (attr_name, [i.get('observedAt') for i in attr_data], [i.get('value', i.get('object')) for i in attr_data])
+
+def _timestamps_to_array(timestamps):
+    return np.array([t[:-1] if t and t.endswith('Z') else t for t in timestamps], dtype='datetime64[ms]')
+
+def _iter_temporal_entities(temporal_data):
+    if isinstance(temporal_data, dict):
+        yield temporal_data
+    else:
+        yield from temporal_data
+
+def to_arrays(temporal_data) -> dict:
+    # temporal_data may be one entity, a list or a generator such as ContextBrokerClient.iter_temporal_entities(),
+    # each entity is converted right away so only the numpy arrays are kept
+    if np is None:
+        raise ImportError('to_arrays requires numpy')
+    chunks = {}
+    for entity in _iter_temporal_entities(temporal_data):
+        for attr_name, timestamps, values in _temporal_series(entity):
+            series_chunks = chunks.setdefault((entity['id'], attr_name), ([], []))
+            series_chunks[0].append(_timestamps_to_array(timestamps))
+            series_chunks[1].append(np.array(values))
+    arrays = {}
+    for key, (timestamp_chunks, value_chunks) in chunks.items():
+        timestamps = np.concatenate(timestamp_chunks)
+        values = np.concatenate(value_chunks)
+        order = np.argsort(timestamps, kind='stable')
+        arrays[key] = (timestamps[order], values[order])
+    return arrays
+
+def to_columns(temporal_data, backend='numpy'):
+    # long format table with entityId, attribute, observedAt and value columns
+    arrays = to_arrays(temporal_data)
+    entity_ids = [np.full(len(t), key[0], dtype=object) for key, (t, _) in arrays.items()]
+    attributes = [np.full(len(t), key[1], dtype=object) for key, (t, _) in arrays.items()]
+    columns = {
+        'entityId': np.concatenate(entity_ids) if entity_ids else np.array([], dtype=object),
+        'attribute': np.concatenate(attributes) if attributes else np.array([], dtype=object),
+        'observedAt': np.concatenate([t for t, _ in arrays.values()]) if arrays else np.array([], dtype='datetime64[ms]'),
+        'value': np.concatenate([v.astype(object) for _, v in arrays.values()]) if arrays else np.array([], dtype=object),
+    }
+    if backend == 'numpy':
+        return columns
+    if backend == 'pandas':
+        import pandas
+        return pandas.DataFrame(columns)
+    if backend == 'arrow':
+        import pyarrow
+        return pyarrow.table({name: pyarrow.array(column) for name, column in columns.items()})
+    raise ValueError('unknown backend '+backend)
+
+def _temporal_rows(temporal_data):
+    # flattens a QuantumLeap page or NGSI-LD temporal entities into (entityId, entityType, attribute, observedAt, value) rows
+    if isinstance(temporal_data, dict) and 'index' in temporal_data:
+        index = temporal_data['index']
+        for attr in temporal_data.get('attributes', []):
+            for observed_at, value in zip(index, attr.get('values', [])):
+                yield {'entityId': temporal_data.get('entityId'), 'entityType': temporal_data.get('entityType'), 'attribute': attr['attrName'], 'observedAt': observed_at, 'value': value}
+        return
+    for entity in _iter_temporal_entities(temporal_data):
+        for attr_name, timestamps, values in _temporal_series(entity):
+            for observed_at, value in zip(timestamps, values):
+                yield {'entityId': entity.get('id'), 'entityType': entity.get('type'), 'attribute': attr_name, 'observedAt': observed_at, 'value': value}
+
+class _ExportSink:
+
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, directory, extension, max_file_rows=5000000, flush_interval=None, codec=None) -> None:
+        self.directory = directory
+        self.extension = extension
+        self.max_file_rows = max_file_rows
+        self.flush_interval = flush_interval
+        self.codec = codec or JsonCodec()
+        self.lock = threading.Lock()
+        self.partitions = {}
+        self.files = []
+        self.closed = False
+        os.makedirs(directory, exist_ok=True)
+        # a resumed export keeps the files listed by the previous run and adds new parts next to them
+        manifest_path = os.path.join(directory, self.MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                self.files = self._recover(json.load(manifest_file).get('files', []))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _recover(self, files):
+        # parts still open when a previous run crashed are cut back to their last flush, or removed when nothing was flushed
+        recovered = []
+        for file_entry in files:
+            path = os.path.join(self.directory, file_entry['path'])
+            if file_entry.get('status') == 'open':
+                if not file_entry['rows'] or not os.path.exists(path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                    logger.warning('🚨 removed orphaned export part %s', file_entry['path'])
+                    continue
+                with open(path, 'r+b') as part_file:
+                    part_file.truncate(file_entry['bytes'])
+                file_entry['status'] = 'closed'
+                logger.warning('🚨 truncated export part %s to its last flush, %d rows', file_entry['path'], file_entry['rows'])
+            recovered.append(file_entry)
+        return recovered
+
+    def _partition(self, kind, entity_type):
+        key = (kind, entity_type)
+        with self.lock:
+            partition = self.partitions.get(key)
+            if partition is None:
+                partition = self.partitions[key] = {'lock': threading.Lock(), 'writer': None, 'stream': None, 'file': None, 'rows': 0, 'buffer': [], 'pending': [], 'flushed_at': time.monotonic()}
+            return partition
+
+    def _next_file(self, kind, entity_type):
+        partition_dir = os.path.join(self.directory, kind, 'entityType='+quote(str(entity_type), safe=''))
+        os.makedirs(partition_dir, exist_ok=True)
+        with self.lock:
+            part = 0
+            while os.path.exists(os.path.join(partition_dir, 'part-%05d%s' % (part, self.extension))):
+                part += 1
+            path = os.path.join(partition_dir, 'part-%05d%s' % (part, self.extension))
+            file_entry = {'path': os.path.relpath(path, self.directory), 'kind': kind, 'entityType': entity_type, 'rows': 0, 'bytes': 0, 'status': 'open'}
+            self.files.append(file_entry)
+            # the part is listed before it exists, so a crash can never leave a file the manifest does not know about
+            self._write_manifest()
+            # the empty file reserves the part number for concurrent writers
+            open(path, 'wb').close()
+        return path, file_entry
+
+    def write_rows(self, rows, kind='temporal', on_durable=None):
+        # rows are appended to their entityType partition as they arrive, nothing else is kept in memory
+        by_type = {}
+        for row in rows:
+            by_type.setdefault(row.get('entityType'), []).append(row)
+        if on_durable is not None and not by_type:
+            on_durable()
+        # rows split over several partitions are durable once the last of them is
+        remaining = [len(by_type)]
+        remaining_lock = threading.Lock()
+        def partition_durable():
+            with remaining_lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                on_durable()
+        for entity_type, type_rows in by_type.items():
+            partition = self._partition(kind, entity_type)
+            with partition['lock']:
+                self._append(partition, kind, entity_type, type_rows)
+                if on_durable is not None:
+                    partition['pending'].append(partition_durable)
+                if self.flush_interval is not None and time.monotonic()-partition['flushed_at'] >= self.flush_interval:
+                    self._commit(self._flush_partition(partition))
+        return sum(len(type_rows) for type_rows in by_type.values())
+
+    def write_temporal(self, temporal_data, on_durable=None):
+        # on_durable is called once the rows are on disk and counted in the manifest, callers checkpoint from it
+        return self.write_rows(_temporal_rows(temporal_data), on_durable=on_durable)
+
+    def write_entities(self, entity_type, entities, on_durable=None):
+        return self.write_rows(({'entityId': e.get('id'), 'entityType': entity_type, 'entity': e} for e in entities or []), kind='entities', on_durable=on_durable)
+
+    def when_durable(self, callback, entity_type=None, kind='temporal'):
+        # runs callback after everything written so far to the partition is durable, right away when nothing is pending
+        partition = self.partitions.get((kind, entity_type))
+        if partition is not None:
+            with partition['lock']:
+                if partition['writer'] is not None:
+                    partition['pending'].append(callback)
+                    return
+        callback()
+
+    def _append(self, partition, kind, entity_type, rows):
+        while rows:
+            if partition['writer'] is None or partition['rows'] >= self.max_file_rows:
+                callbacks = self._close_partition(partition)
+                # the manifest written for the next part already lists the closed one
+                path, partition['file'] = self._next_file(kind, entity_type)
+                self._run_callbacks(callbacks)
+                partition['writer'] = self._open(path, kind)
+                partition['rows'] = 0
+            take = self.max_file_rows-partition['rows']
+            self._write(partition, rows[:take])
+            partition['rows'] += len(rows[:take])
+            rows = rows[take:]
+
+    def _mark_flushed(self, partition):
+        partition['file']['rows'] = partition['rows']
+        partition['file']['bytes'] = os.path.getsize(os.path.join(self.directory, partition['file']['path']))
+
+    def _take_pending(self, partition):
+        partition['flushed_at'] = time.monotonic()
+        callbacks, partition['pending'] = partition['pending'], []
+        return callbacks
+
+    def _flush_partition(self, partition):
+        # returns the callbacks waiting on the flushed rows, they run once the manifest is written
+        if partition['writer'] is None:
+            return []
+        self._sync(partition)
+        self._mark_flushed(partition)
+        return self._take_pending(partition)
+
+    def _close_partition(self, partition):
+        if partition['writer'] is None:
+            return []
+        self._close_writer(partition)
+        partition['writer'] = None
+        self._mark_flushed(partition)
+        partition['file']['status'] = 'closed'
+        return self._take_pending(partition)
+
+    def _run_callbacks(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error('💥 export durability callback failed: %s', repr(e))
+
+    def _commit(self, callbacks):
+        with self.lock:
+            self._write_manifest()
+        self._run_callbacks(callbacks)
+
+    def flush(self):
+        callbacks = []
+        for partition in list(self.partitions.values()):
+            with partition['lock']:
+                callbacks.extend(self._flush_partition(partition))
+        self._commit(callbacks)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        callbacks = []
+        for partition in self.partitions.values():
+            with partition['lock']:
+                callbacks.extend(self._close_partition(partition))
+        self._commit(callbacks)
+
+    def _write_manifest(self):
+        # only rows that were flushed are counted, the manifest never promises more than a reader will find
+        manifest = {
+            'format': self.format,
+            'compression': self.compression,
+            'createdAt': _format_time(datetime.now(timezone.utc)),
+            'columns': self.columns,
+            'rows': sum(f['rows'] for f in self.files if f['kind'] == 'temporal'),
+            'entities': sum(f['rows'] for f in self.files if f['kind'] == 'entities'),
+            'files': self.files,
+        }
+        manifest_path = os.path.join(self.directory, self.MANIFEST)
+        with open(manifest_path+'.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(manifest_path+'.tmp', manifest_path)
+
+class NdjsonSink(_ExportSink):
+
+    format = 'ndjson'
+    columns = ['entityId', 'entityType', 'attribute', 'observedAt', 'value']
+
+    def __init__(self, directory, compression='gzip', level=None, max_file_rows=5000000, flush_interval=10.0, codec=None) -> None:
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        if compression not in (None, 'gzip', 'zstd'):
+            raise ValueError('unknown compression '+str(compression))
+        self.compression = compression
+        self.level = level
+        extension = {None: '.ndjson', 'gzip': '.ndjson.gz', 'zstd': '.ndjson.zst'}[compression]
+        # every flush_interval seconds a partition ends its compressed member and is synced to disk
+        super().__init__(directory, extension, max_file_rows, flush_interval, codec)
+
+    def _open(self, path, kind):
+        return open(path, 'wb')
+
+    def _stream(self, partition):
+        # every flush ends a gzip member or a zstd frame, concatenated members and frames are still one valid file
+        if partition['stream'] is None:
+            if self.compression == 'gzip':
+                partition['stream'] = gzip.GzipFile(fileobj=partition['writer'], mode='wb', compresslevel=self.level or 6)
+            elif self.compression == 'zstd':
+                partition['stream'] = zstandard.ZstdCompressor(level=self.level or 3).stream_writer(partition['writer'], closefd=False)
+            else:
+                partition['stream'] = partition['writer']
+        return partition['stream']
+
+    def _write(self, partition, rows):
+        dumps = self.codec.dumps
+        if partition['file']['kind'] == 'entities':
+            self._stream(partition).write(b''.join(dumps(row['entity'])+b'\n' for row in rows))
+        else:
+            self._stream(partition).write(b''.join(dumps(row)+b'\n' for row in rows))
+
+    def _sync(self, partition):
+        if partition['stream'] is not None and partition['stream'] is not partition['writer']:
+            partition['stream'].close()
+        partition['stream'] = None
+        partition['writer'].flush()
+        os.fsync(partition['writer'].fileno())
+
+    def _close_writer(self, partition):
+        self._sync(partition)
+        partition['writer'].close()
+
+class ParquetSink(_ExportSink):
+
+    format = 'parquet'
+    columns = ['entityId', 'attribute', 'observedAt', 'value', 'valueText']
+
+    def __init__(self, directory, compression='zstd', row_group_size=100000, max_file_rows=5000000, codec=None) -> None:
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.compression = compression
+        self.row_group_size = row_group_size
+        # numbers go to value, anything else is kept as text (JSON for structured values) so every file shares one schema,
+        # entityType is not stored in the files since readers get it back from the hive partition directory
+        self.schemas = {
+            'temporal': pyarrow.schema([
+                ('entityId', pyarrow.string()),
+                ('attribute', pyarrow.string()),
+                ('observedAt', pyarrow.timestamp('ms', tz='UTC')),
+                ('value', pyarrow.float64()),
+                ('valueText', pyarrow.string()),
+            ]),
+            'entities': pyarrow.schema([
+                ('entityId', pyarrow.string()),
+                ('entity', pyarrow.string()),
+            ]),
+        }
+        # a parquet file is only readable once its footer is written, so rows become durable when their part
+        # is rotated at max_file_rows or the sink is flushed or closed, never page by page
+        super().__init__(directory, '.parquet', max_file_rows, None, codec)
+
+    def _open(self, path, kind):
+        return self.pyarrow.parquet.ParquetWriter(path, self.schemas[kind], compression=self.compression)
+
+    def _write(self, partition, rows):
+        partition['buffer'].extend(rows)
+        if len(partition['buffer']) >= self.row_group_size:
+            self._write_row_group(partition)
+
+    def _flush_partition(self, partition):
+        # an explicit flush finalizes the current part, the next rows start a new one
+        return self._close_partition(partition)
+
+    def _write_row_group(self, partition):
+        rows = partition['buffer']
+        if not rows:
+            return
+        partition['buffer'] = []
+        if partition['file']['kind'] == 'entities':
+            columns = {
+                'entityId': [row['entityId'] for row in rows],
+                'entity': [self.codec.dumps(row['entity']).decode('utf-8') for row in rows],
+            }
+        else:
+            values = [row['value'] for row in rows]
+            columns = {
+                'entityId': [row['entityId'] for row in rows],
+                'attribute': [row['attribute'] for row in rows],
+                'observedAt': [_parse_time(row['observedAt']) if row['observedAt'] else None for row in rows],
+                'value': [float(v) if isinstance(v, (int, float)) else None for v in values],
+                'valueText': [None if isinstance(v, (int, float)) or v is None else v if isinstance(v, str) else self.codec.dumps(v).decode('utf-8') for v in values],
+            }
+        table = self.pyarrow.table(columns, schema=self.schemas[partition['file']['kind']])
+        partition['writer'].write_table(table)
 
+    def _close_writer(self, partition):
+        self._write_row_group(partition)
+        partition['writer'].close()